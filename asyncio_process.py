@@ -1,10 +1,11 @@
 import os
 import asyncio
-import multiprocessing
 from subprocess import Popen, PIPE, STDOUT
 
 from tqdm import tqdm
 
+from multiprocess_video import schedule
+
 def extract_frames_ffmpeg(info):
     print("Extracting frames from {}".format(info[0]))
 
@@ -24,9 +25,7 @@ def extract_frames_ffmpeg(info):
 
 async def extract(infos):
     try:
-        with multiprocessing.Pool(processes=4) as pool:
-            pool.map(extract_frames_ffmpeg, infos)
-        pool.close()
+        schedule(extract_frames_ffmpeg, infos, processes=4)
 
         return "Success"
     except Exception as e:
@@ -1,35 +1,65 @@
 import os
 import asyncio
-from subprocess import Popen, PIPE, STDOUT
+from asyncio.subprocess import PIPE, DEVNULL
 
-async def extract_frames_ffmpeg(video_path, folder_name):
+async def print_stderr(video_path, process):
+    # Print ffmpeg's messages as they come, without blocking the event loop
+    async for line in process.stderr:
+        print("{} : {}".format(video_path, line.rstrip().decode('utf-8')))
+
+async def extract_frames_ffmpeg(video_path, folder_name, timeout=None):
     print("Extracting frames from {}".format(video_path))
 
     abs_video_path = os.path.abspath(video_path)
     folder_path = "data/{:s}".format(folder_name)
 
-    command = "ffmpeg -hide_banner -loglevel error -i {:s} {:s}/out-%04d.jpg".format(abs_video_path, folder_path)
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+               "-i", abs_video_path, "{:s}/out-%04d.jpg".format(folder_path)]
+
+    # Execute Command, the event loop keeps running other coroutines while ffmpeg works
+    process = await asyncio.create_subprocess_exec(*command, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+    try:
+        await asyncio.wait_for(asyncio.gather(print_stderr(video_path, process), process.wait()), timeout)
+    finally:
+        # timed out or cancelled, don't leave ffmpeg running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    if process.returncode != 0:
+        print("Extracting frames from {:s} failed with exit code {}!".format(abs_video_path, process.returncode))
+    else:
+        print("Extracting frames from {:s} done!".format(abs_video_path))
+    return process.returncode
+
+async def extract(infos, max_processes : int =4, timeout=None):
+    # Extract every video concurrently, with at most max_processes ffmpeg processes in flight
+    # and at most timeout seconds per video. One failing video does not stop the others.
+    semaphore = asyncio.Semaphore(max_processes)
 
-    # Execute Command
-    process = Popen(command, stdout=PIPE, shell=True, stderr=STDOUT, bufsize=1, close_fds=True)
-    for line in iter(process.stdout.readline, b''):
-        print(line.rstrip().decode('utf-8'))
-    process.stdout.close()
-    process.wait()
+    async def extract_limited(video_path, folder_name):
+        async with semaphore:
+            return await extract_frames_ffmpeg(video_path, folder_name, timeout=timeout)
 
-    print("Extracting frames from {:s} done!".format(abs_video_path))
+    results = await asyncio.gather(*[extract_limited(video_path, folder_name) for video_path, folder_name in infos],
+                                   return_exceptions=True)
+
+    for (video_path, _), result in zip(infos, results):
+        if isinstance(result, asyncio.TimeoutError):
+            print("Extracting frames from {} timed out after {}s!".format(video_path, timeout))
+        elif isinstance(result, BaseException):
+            print("Extracting frames from {} failed : {!r}".format(video_path, result))
+    return results
 
 async def main():
-    extract1 = loop.create_task(extract_frames_ffmpeg(video_path="videos/1.mp4",
-                                                      folder_name="1"))
-    extract2 = loop.create_task(extract_frames_ffmpeg(video_path="videos/2.mp4",
-                                                      folder_name="2"))
-    extract3 = loop.create_task(extract_frames_ffmpeg(video_path="videos/3.mp4",
-                                                      folder_name="3"))
-    extract4 = loop.create_task(extract_frames_ffmpeg(video_path="videos/4.mp4",
-                                                      folder_name="4"))
+    infos = [["videos/1.mp4", "1"],
+             ["videos/2.mp4", "2"],
+             ["videos/3.mp4", "3"],
+             ["videos/4.mp4", "4"]]
+
+    extract1 = loop.create_task(extract(infos, max_processes=4, timeout=600))
 
-    await asyncio.wait([extract1, extract2, extract3, extract4])
+    await asyncio.wait([extract1])
 
 if __name__ == "__main__":
     try:
@@ -40,4 +70,4 @@ if __name__ == "__main__":
         print("lee")
         pass
     finally:
-        loop.close()
\ No newline at end of file
+        loop.close()
@@ -1,37 +1,106 @@
 import os
 import asyncio
-from subprocess import Popen, PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 
-async def extract_frames_opencv(video_path, folder_name):
+class AsyncVideoSource(object):
+
+    def __init__(self, video_path, prefetch : int =4, executor=None):
+        """
+        Iterate over the frames of a video with `async for`, VideoCapture.read runs in a
+        thread pool (cv2 releases the GIL while decoding) so the event loop is never blocked.
+        Parameters
+        ----------
+        video_path : str
+                     path of the video
+        prefetch   : int
+                     number of decoded frames kept ready ahead of the consumer,
+                     decoding pauses while this many frames wait
+        executor   : concurrent.futures.Executor
+                     thread pool the decoding runs in, the loop's default executor if None
+        """
+        self.video_path = os.path.abspath(video_path)
+        self.executor = executor
+        self._frames = asyncio.Queue(maxsize=prefetch)
+        self._decoder = None
+
+    async def _decode(self):
+        loop = asyncio.get_running_loop()
+        vidcap = await loop.run_in_executor(self.executor, cv2.VideoCapture, self.video_path)
+        read = None
+        try:
+            while True:
+                read = loop.run_in_executor(self.executor, vidcap.read)
+                # shielded, a cancelled decoder still knows when the read running in the pool is over
+                success, image = await asyncio.shield(read)
+                if not success:
+                    break
+                await self._frames.put(image)  # waits while `prefetch` frames are not consumed yet
+            await self._frames.put(None)
+        except Exception as e:
+            await self._frames.put(e)
+        finally:
+            if read is not None and not read.done():
+                await asyncio.wait([read])
+            await loop.run_in_executor(self.executor, vidcap.release)
+
+    def __aiter__(self):
+        if self._decoder is None:
+            self._decoder = asyncio.ensure_future(self._decode())
+        return self
+
+    async def __anext__(self):
+        frame = await self._frames.get()
+        if frame is None:
+            raise StopAsyncIteration
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+    async def aclose(self):
+        # Stop decoding when the consumer leaves the loop early
+        if self._decoder is not None and not self._decoder.done():
+            self._decoder.cancel()
+            try:
+                await self._decoder
+            except asyncio.CancelledError:
+                pass
+
+async def extract_frames_opencv(video_path, folder_name, executor=None):
     print("Extracting frames from {}".format(video_path))
 
     abs_video_path = os.path.abspath(video_path)
     folder_path = "data/{:s}".format(folder_name)
+    loop = asyncio.get_running_loop()
 
-    vidcap = cv2.VideoCapture(abs_video_path)
-    success,image = vidcap.read()
     count = 0
-    while success:
-        cv2.imwrite("%s/out-%04d.jpg" % (folder_path, count), image)     # save frame as JPEG file      
-        success,image = vidcap.read()
-        count += 1
+    source = AsyncVideoSource(abs_video_path, prefetch=4, executor=executor)
+    try:
+        async for image in source:
+            # save frame as JPEG file, encoding runs in the thread pool as well
+            await loop.run_in_executor(executor, cv2.imwrite, "%s/out-%04d.jpg" % (folder_path, count), image)
+            count += 1
+    finally:
+        await source.aclose()
 
     print("Extracting frames from {:s} done!".format(abs_video_path))
 
 
 async def main():
+    executor = ThreadPoolExecutor(max_workers=8)  # shared by the decoders and encoders of every video
+
     extract1 = loop.create_task(extract_frames_opencv(video_path="videos/1.mp4",
-                                                      folder_name="1"))
+                                                      folder_name="1", executor=executor))
     extract2 = loop.create_task(extract_frames_opencv(video_path="videos/2.mp4",
-                                                      folder_name="2"))
+                                                      folder_name="2", executor=executor))
     extract3 = loop.create_task(extract_frames_opencv(video_path="videos/3.mp4",
-                                                      folder_name="3"))
+                                                      folder_name="3", executor=executor))
     extract4 = loop.create_task(extract_frames_opencv(video_path="videos/4.mp4",
-                                                      folder_name="4"))
+                                                      folder_name="4", executor=executor))
 
     await asyncio.wait([extract1, extract2, extract3, extract4])
+    executor.shutdown()
 
 if __name__ == "__main__":
     try:
@@ -42,4 +111,4 @@ if __name__ == "__main__":
         print("lee")
         pass
     finally:
-        loop.close()
\ No newline at end of file
+        loop.close()
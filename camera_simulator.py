@@ -0,0 +1,209 @@
+"""
+Local stand-in for a rack of CCTV cameras, to load test the stream readers without a network
+
+A synthetic (ffmpeg testsrc2) or file-backed clip is encoded once to H.264 with the requested
+resolution, frame rate and bitrate, split into access units, and served by N simulated cameras
+1. tcp  : camera i listens on tcp://host:port+i, every connection gets the stream from its first keyframe
+2. fifo : camera i writes to the named pipe folder/camera-iii.264 whenever a reader has it open
+Every camera sends one access unit per frame at real-time pacing, each late by a random
+0..jitter seconds, and loops the clip. Like a camera, a simulated camera drops frames (up to
+the next keyframe) instead of buffering them when its reader does not keep up.
+All cameras are served from a single asyncio event loop.
+
+    python camera_simulator.py --streams 32 --fps 25 --size 1280x720 --bitrate 2M --jitter 0.005
+"""
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess as sp
+
+from h264_stream import AccessUnitParser
+
+def encode_clip(path, source=None, seconds : int =10, fps : int =25, size : str ="1280x720", bitrate : str ="2M"):
+    # Encode the clip the cameras send, testsrc2 if source is None, with a keyframe every second
+    if source is None:
+        inputs = ["-f", "lavfi", "-i", "testsrc2=size={}:rate={}".format(size, fps)]
+    else:
+        inputs = ["-stream_loop", "-1", "-i", source]
+    sp.check_call(["ffmpeg", "-loglevel", "error", "-nostdin", "-y"] + inputs +
+                  ["-t", str(seconds), "-an", "-vf", "scale={},fps={}".format(size.replace("x", ":"), fps),
+                   "-c:v", "libx264", "-preset", "veryfast", "-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate,
+                   "-g", str(fps), "-bf", "0", "-f", "h264", path])
+
+def load_units(path):
+    # Access units of an H.264 Annex-B file, as (bytes, keyframe)
+    parser = AccessUnitParser()
+    with open(path, "rb") as clip_file:
+        units = parser.feed(clip_file.read())
+    units += parser.flush()
+    assert units and units[0][1], "The clip must start with a keyframe."
+    return units
+
+class CameraSimulator(object):
+
+    def __init__(self, units, num_streams : int =8, fps : float =25, jitter : float =0.0, transport : str ="tcp",
+                 host : str ="127.0.0.1", port : int =8554, folder=None, duration=None, max_buffer : int =4 * 1024**2):
+        """
+        Parameters
+        ----------
+        units       : list
+                      (access unit bytes, keyframe) of the clip every camera loops, see load_units
+        num_streams : int
+                      number of cameras
+        fps         : float
+                      frames sent per second by every camera
+        jitter      : float
+                      every frame is sent up to this many seconds late, uniformly at random
+        transport   : str
+                      "tcp" or "fifo"
+        host        : str
+                      address the tcp cameras listen on
+        port        : int
+                      port of the first tcp camera, camera i listens on port + i
+        folder      : str
+                      folder of the named pipes of the fifo cameras, a new temporary folder if None
+        duration    : float
+                      seconds a connection is served before the camera hangs up, None for forever
+        max_buffer  : int
+                      bytes a camera buffers for a slow reader before it drops frames
+        """
+        assert transport in ("tcp", "fifo"), "transport must be tcp or fifo."
+        self.units = units
+        self.num_streams = num_streams
+        self.fps = fps
+        self.jitter = jitter
+        self.transport = transport
+        self.host = host
+        self.port = port
+        self.folder = folder if folder is not None or transport != "fifo" else tempfile.mkdtemp(prefix="cameras-")
+        self.duration = duration
+        self.max_buffer = max_buffer
+
+        self.sent = [0] * num_streams       # frames sent per camera
+        self.dropped = [0] * num_streams    # frames dropped per camera because its reader was too slow
+        self.connections = [0] * num_streams
+
+    @property
+    def urls(self):
+        # Inputs for CCTVReader / CCTVMultiplexer, one per camera
+        if self.transport == "tcp":
+            return ["tcp://{}:{}".format(self.host, self.port + i) for i in range(self.num_streams)]
+        return [os.path.join(self.folder, "camera-{:03d}.264".format(i)) for i in range(self.num_streams)]
+
+    async def _stream(self, index, transport):
+        # Send the clip in a loop at real-time pacing, until the duration is over or the reader left
+        self.connections[index] += 1
+        start = time.perf_counter()
+        dropping = False
+        frame = 0
+        while not transport.is_closing():
+            data, keyframe = self.units[frame % len(self.units)]
+
+            due = start + frame / self.fps
+            if self.duration is not None and due - start >= self.duration:
+                break
+            delay = due + random.uniform(0, self.jitter) - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # a reader that does not keep up loses frames up to the next keyframe, the stream stays decodable
+            if transport.get_write_buffer_size() > self.max_buffer or (dropping and not keyframe):
+                dropping = True
+                self.dropped[index] += 1
+            else:
+                dropping = False
+                transport.write(data)
+                self.sent[index] += 1
+            frame += 1
+
+    async def _serve_tcp(self, index):
+        async def handle(reader, writer):
+            try:
+                await self._stream(index, writer.transport)
+            finally:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
+
+        server = await asyncio.start_server(handle, self.host, self.port + index)
+        async with server:
+            await server.serve_forever()
+
+    async def _serve_fifo(self, index):
+        loop = asyncio.get_running_loop()
+        path = self.urls[index]
+        if not os.path.exists(path):
+            os.mkfifo(path)
+
+        while True:
+            # non-blocking open fails until a reader has the pipe open, waiting in a thread would take
+            # one thread per camera
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                await asyncio.sleep(0.05)
+                continue
+
+            transport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(fd, "wb", buffering=0))
+            try:
+                await self._stream(index, transport)
+            finally:
+                transport.close()
+
+            # a new pipe for the next reader, the last one keeps the old pipe and reads it to its end
+            os.remove(path)
+            os.mkfifo(path)
+
+    async def serve(self):
+        # Serve every camera until cancelled
+        serve = self._serve_tcp if self.transport == "tcp" else self._serve_fifo
+        try:
+            await asyncio.gather(*[serve(i) for i in range(self.num_streams)])
+        finally:
+            if self.transport == "fifo":
+                for path in self.urls:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def report(self):
+        return {"sent": sum(self.sent), "dropped": sum(self.dropped), "connections": sum(self.connections)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve simulated H.264 cameras on this machine")
+    parser.add_argument("--streams", type=int, default=8, help="number of cameras")
+    parser.add_argument("--fps", type=int, default=25, help="frame rate")
+    parser.add_argument("--size", default="1280x720", help="resolution, WxH")
+    parser.add_argument("--bitrate", default="2M", help="bitrate of the stream")
+    parser.add_argument("--jitter", type=float, default=0.0, help="most seconds a frame is sent late")
+    parser.add_argument("--source", default=None, help="video the cameras show, a test pattern if not given")
+    parser.add_argument("--seconds", type=int, default=10, help="length of the clip the cameras loop")
+    parser.add_argument("--transport", default="tcp", choices=["tcp", "fifo"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8554, help="port of the first tcp camera")
+    parser.add_argument("--folder", default=None, help="folder of the named pipes of the fifo cameras")
+    parser.add_argument("--duration", type=float, default=None, help="seconds a camera serves a connection")
+    args = parser.parse_args()
+
+    clip = os.path.join(tempfile.gettempdir(), "camera-{}-{}-{}-{}.264".format(
+        os.path.basename(args.source or "testsrc2"), args.size, args.fps, args.bitrate))
+    if not os.path.exists(clip):
+        encode_clip(clip, source=args.source, seconds=args.seconds, fps=args.fps, size=args.size, bitrate=args.bitrate)
+
+    simulator = CameraSimulator(load_units(clip), num_streams=args.streams, fps=args.fps, jitter=args.jitter,
+                                transport=args.transport, host=args.host, port=args.port, folder=args.folder,
+                                duration=args.duration)
+    for url in simulator.urls:
+        print(url, flush=True)
+
+    try:
+        asyncio.run(simulator.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Cameras : {}".format(simulator.report()))
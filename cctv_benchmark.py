@@ -0,0 +1,91 @@
+"""
+Thread per camera (CCTVReader) against a single selector thread (CCTVMultiplexer) reading many cameras
+
+The cameras are served by camera_simulator.py in a child process, over local tcp, paced at their
+frame rate like live cameras. For each number of streams the readers run until every camera hung up,
+and report
+1. cpu      : CPU time of this process (the readers, not ffmpeg) per second of wall time, 100% = one core
+2. lag      : how late every access unit was handed over, compared to the frame rate pacing of its stream,
+              p50 / p99 / max, frames ffmpeg handed over in one burst once it probed the input are left out
+
+    python cctv_benchmark.py [seconds per run]
+"""
+
+import os
+import sys
+import time
+import signal
+import subprocess as sp
+
+import numpy as np
+
+from multiple_rtsp import CCTVReader, CCTVMultiplexer
+
+class ArrivalLog(object):
+    # Stands in for the queue of a camera, keeps only the time every access unit is handed over
+    def __init__(self):
+        self.times = []
+
+    def put(self, unit):
+        self.times.append(time.perf_counter())
+
+    put_nowait = put  # never full, CCTVMultiplexer drops nothing
+
+def frame_lag(logs, fps):
+    # Lateness of every access unit against its stream's pacing, the 1st percentile of a stream is the zero.
+    # A stream is paced from the first frame that came more than half a frame after the one before it
+    lags = []
+    for log in logs:
+        times = np.asarray(log.times)
+        paced = np.nonzero(np.diff(times) > 0.5 / fps)[0]
+        if paced.size:
+            times = times[paced[0] + 1:]
+            lag = (times - times[0]) - np.arange(times.size) / fps
+            lags.append(np.maximum(lag - np.percentile(lag, 1), 0))
+    return np.concatenate(lags) if lags else np.zeros(1)
+
+def run_threads(urls):
+    logs = [ArrivalLog() for _ in urls]
+    readers = [CCTVReader(log, url) for log, url in zip(logs, urls)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    return logs
+
+def run_selector(urls):
+    logs = [ArrivalLog() for _ in urls]
+    multiplexer = CCTVMultiplexer()
+    for log, url in zip(logs, urls):
+        multiplexer.add(log, url)
+    multiplexer.start()
+    multiplexer.join()
+    return logs
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    fps = 25
+
+    for num_streams in [8, 32, 128]:
+        # every connection gets `seconds` of stream, then the camera hangs up and the readers end
+        simulator = sp.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "camera_simulator.py"),
+                              "--streams", str(num_streams), "--fps", str(fps), "--duration", str(seconds)],
+                             stdout=sp.PIPE, universal_newlines=True)
+        urls = [simulator.stdout.readline().strip() for _ in range(num_streams)]
+        time.sleep(1)  # every camera listens
+        assert simulator.poll() is None, "The camera simulator did not start, is port 8554 in use?"
+
+        for name, run in [("threads", run_threads), ("selector", run_selector)]:
+            _start, _cpu = time.perf_counter(), os.times()
+            logs = run(urls)
+            elapsed, cpu = time.perf_counter() - _start, os.times()
+            cpu_time = (cpu.user - _cpu.user) + (cpu.system - _cpu.system)
+
+            lag = frame_lag(logs, fps) * 1000
+            units = sum(len(log.times) for log in logs)
+            print("{:3d} streams, {:8s} : {} frames in {:.1f}s, cpu {:5.1f}%, lag p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+                num_streams, name, units, elapsed, 100 * cpu_time / elapsed,
+                np.percentile(lag, 50), np.percentile(lag, 99), lag.max()))
+
+        simulator.send_signal(signal.SIGINT)
+        print(simulator.communicate()[0].strip())
@@ -0,0 +1,33 @@
+"""
+Decoding throughput of cv2.VideoCapture against an ffmpeg rawvideo pipe read into preallocated buffers
+"""
+
+import sys
+import time
+
+import cv2
+
+from ffmpeg_source import FFmpegVideoCapture
+
+def decode_all(open_capture, video):
+    # the capture is opened inside the timed section, an ffmpeg pipe started earlier
+    # would already be decoding on another core while the other backend is timed
+    count = 0
+    _start = time.perf_counter()
+    vidcap = open_capture(video)
+    while True:
+        success, frame = vidcap.read()
+        if not success:
+            break
+        count += 1
+    elapsed = time.perf_counter() - _start
+    vidcap.release()
+    return count, elapsed
+
+if __name__ == '__main__':
+    videos = sys.argv[1:] or ["videos/1.mp4", "videos/2.mp4", "videos/3.mp4", "videos/4.mp4"]
+
+    for video in videos:
+        for name, open_capture in [("opencv", cv2.VideoCapture), ("ffmpeg", FFmpegVideoCapture)]:
+            count, elapsed = decode_all(open_capture, video)
+            print("{} {} : {} frames in {:.3f}s, {:.1f} frames/s".format(video, name, count, elapsed, count / elapsed))
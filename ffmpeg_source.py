@@ -0,0 +1,183 @@
+"""
+Decode videos with an ffmpeg child process instead of cv2.VideoCapture
+
+ffmpeg writes raw bgr24 frames to its stdout, every frame is read with readinto() straight into
+one of a few preallocated frame buffers, so no bytes object or array is allocated per frame and
+nothing is encoded to / decoded from JPEG on the way.
+FFmpegVideoCapture has the read() / isOpened() / release() methods of cv2.VideoCapture and can
+replace it in the frame readers, readinto() decodes into a buffer the caller owns instead.
+
+probe_keyframes lists the keyframes of a video from its packets, for splitting a video into
+independently decodable segments or for decoding its keyframes only.
+"""
+
+import json
+from subprocess import Popen, PIPE, DEVNULL, check_output
+
+import numpy as np
+
+class FFmpegVideoCapture(object):
+
+    def __init__(self, video_path, num_buffers : int =4, width=None, height=None, ffmpeg="ffmpeg", ffprobe="ffprobe"):
+        """
+        Start decoding a video.
+        Parameters
+        ----------
+        video_path  : str
+                      path or url of the video
+        num_buffers : int
+                      number of frame buffers the frames are read into in turn,
+                      a frame returned by read() stays valid for num_buffers - 1 more reads
+        width       : int
+                      width of the frames, probed with ffprobe if None.
+                      ffmpeg applies the rotation of the video, like cv2.VideoCapture does,
+                      so this is the width once rotated
+        height      : int
+                      height of the frames, probed with ffprobe if None
+        ffmpeg      : str
+                      ffmpeg executable
+        ffprobe     : str
+                      ffprobe executable
+        """
+        if width is None or height is None:
+            width, height = self.probe(video_path, ffprobe=ffprobe)
+        self.width = width
+        self.height = height
+
+        self._buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(num_buffers)]
+        self._next = 0
+
+        command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin",
+                   "-i", video_path,
+                   "-f", "rawvideo",        # no container, frames back to back
+                   "-pix_fmt", "bgr24",     # same layout as the frames of cv2.VideoCapture
+                   "-"]                     # Output is a pipe
+        # unbuffered, readinto() then reads from the pipe straight into the frame buffers
+        self.pipe = Popen(command, stdin=DEVNULL, stdout=PIPE, bufsize=0)
+
+    @staticmethod
+    def probe(video_path, ffprobe="ffprobe"):
+        """
+        Width and height of the frames ffmpeg decodes from the first video stream of a video.
+        ffmpeg autorotates, the coded size of a video rotated by 90 or 270 degrees
+        (phone videos mostly) is swapped.
+        """
+        output = check_output([ffprobe, "-v", "error", "-select_streams", "v:0",
+                               "-show_entries", "stream=width,height:stream_tags=rotate:stream_side_data=rotation",
+                               "-of", "json", video_path])
+        stream = json.loads(output.decode("utf-8"))["streams"][0]
+        # the display matrix side data of ffprobe >= 5, the rotate tag of older versions
+        rotation = stream.get("tags", {}).get("rotate", 0)
+        for side_data in stream.get("side_data_list", []):
+            rotation = side_data.get("rotation", rotation)
+        width, height = int(stream["width"]), int(stream["height"])
+        if round(float(rotation)) % 180:
+            width, height = height, width
+        return width, height
+
+    def isOpened(self):
+        return self.pipe.stdout is not None and not self.pipe.stdout.closed
+
+    def read(self):
+        """
+        Read the next frame into the next frame buffer.
+
+        Returns
+        -------
+        success     : bool
+                      False once the video ended
+        frame       : numpy array
+                      uint8 numpy array of shape (height, width, 3) in BGR format,
+                      a view of a reused frame buffer, None once the video ended
+        """
+        frame = self._buffers[self._next]
+        if not self.readinto(frame):
+            return False, None
+
+        self._next = (self._next + 1) % len(self._buffers)
+        return True, frame
+
+    def readinto(self, frame):
+        """
+        Read the next frame into a buffer owned by the caller, e.g the back buffer of a mailbox.
+        Parameters
+        ----------
+        frame       : numpy array
+                      C-contiguous uint8 numpy array of shape (height, width, 3)
+
+        Returns
+        -------
+        success     : bool
+                      False once the video ended, `frame` is then left partly written
+        """
+        if not self.isOpened():
+            return False
+
+        view = memoryview(frame).cast("B")
+        filled = 0
+        while filled < len(view):
+            count = self.pipe.stdout.readinto(view[filled:])
+            if not count:
+                # a frame cut short by the end of the stream is dropped, like cv2.VideoCapture does
+                return False
+            filled += count
+
+        return True
+
+    def release(self):
+        if self.pipe.stdout is not None and not self.pipe.stdout.closed:
+            self.pipe.stdout.close()
+        if self.pipe.poll() is None:
+            self.pipe.terminate()
+        self.pipe.wait()
+
+    def __iter__(self):
+        while True:
+            success, frame = self.read()
+            if not success:
+                self.release()
+                return
+            yield frame
+
+def probe_keyframes(video_path, ffprobe="ffprobe", times : bool =False):
+    """
+    Display indices of the keyframes and the number of frames of a video,
+    from its packets only, nothing is decoded.
+    Parameters
+    ----------
+    video_path  : str
+                  path of the video
+    ffprobe     : str
+                  ffprobe executable
+    times       : bool
+                  also return the presentation time of every frame
+
+    Returns
+    -------
+    keyframes   : list
+                  sorted display indices of the keyframes
+    num_frames  : int
+                  number of frames of the video
+    frame_times : list
+                  only if `times`, seconds from the first frame to every frame in display order,
+                  the time cv2.CAP_PROP_POS_MSEC / 1000 reports once the frame was read
+    """
+    command = [ffprobe, "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts,pts_time,flags", "-of", "csv=p=0", video_path]
+    output = check_output(command).decode("utf-8")
+
+    packets = []
+    for line in output.splitlines():
+        fields = line.split(",")  # pts, pts_time, flags
+        if fields[0].strip().lstrip("-").isdigit():
+            packets.append((int(fields[0]), float(fields[1]), "K" in fields[-1]))
+
+    # packets come in decode order, the display index of a frame is its rank by pts
+    display_order = sorted(packets)
+    rank = {pts: index for index, (pts, _, _) in enumerate(display_order)}
+    keyframes = sorted(rank[pts] for pts, _, key in packets if key)
+
+    if times:
+        first = display_order[0][1] if display_order else 0.0
+        return keyframes, len(display_order), [pts_time - first for _, pts_time, _ in display_order]
+    return keyframes, len(display_order)
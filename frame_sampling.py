@@ -0,0 +1,41 @@
+"""
+Keep only some of the frames of a video while decoding it
+
+sample_frames keeps every stride-th frame, about fps frames a second, or a given set of frames,
+e.g the keyframes listed by ffmpeg_source.probe_keyframes. The frames in between are only grab()bed,
+so they are demuxed and decoded but never retrieved or color converted.
+"""
+
+import cv2
+
+def sample_frames(vidcap, stride : int =1, fps=None, keyframes=None):
+    # Yield (source frame index, image) of the frames kept by one sampling mode,
+    # every stride-th frame, about fps frames a second, or only the frames in `keyframes`.
+    # Frames in between are only grab()bed, never retrieved / color converted
+    if fps is not None:
+        source_fps = vidcap.get(cv2.CAP_PROP_FPS)
+        step = source_fps / fps if source_fps > fps else 1.0
+    else:
+        step = float(stride)
+    wanted = None if keyframes is None else set(keyframes)
+    last = max(wanted, default=-1) if wanted is not None else None
+
+    index = 0
+    next_index = 0.0
+    while last is None or index <= last:
+        if wanted is not None:
+            keep = index in wanted
+        else:
+            keep = index >= next_index - 1e-6
+            if keep:
+                next_index += step
+
+        if keep:
+            success, image = vidcap.read()
+        else:
+            success, image = vidcap.grab(), None
+        if not success:
+            return
+        if keep:
+            yield index, image
+        index += 1
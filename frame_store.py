@@ -0,0 +1,355 @@
+"""
+Single-file frame store, replacing one out-%04d.npy per frame or batch
+
+A store at "data/1/frames" is made of three files
+1. frames.json : header, dtype and shape of a single frame, names of the index fields
+2. frames.bin  : every frame appended back to back, raw C-order bytes
+3. frames.idx  : one row of int64 index fields (e.g frame number, stream, batch) per frame
+
+All frames of a store have the same shape, so frame i lives at byte i * frame_nbytes of frames.bin
+and consumers np.memmap the whole file once and slice any range of frames from it.
+
+AsyncFrameStoreWriter moves the writes to background threads, so disk latency never throttles
+the decode / preprocess loop that produces the frames.
+
+Stores written in parts, e.g one per segment of a video decoded in parallel, are joined
+back into one store with merge_stores.
+
+Stores of uint8 letterboxed canvases are 4x smaller than float32 ones, FrameStore.load
+divides them by 255 while it copies them into the float32 batch, the same values Preprocess gives.
+"""
+
+import os
+import json
+import time
+import threading
+from queue import Queue
+
+import numpy as np
+
+class FrameStoreWriter(object):
+
+    def __init__(self, path, frame_shape, dtype=np.float32, fields=("frame",)):
+        """
+        Open a new frame store for appending.
+        Parameters
+        ----------
+        path        : str
+                      path of the store without extension, e.g "data/1/frames"
+        frame_shape : tuple
+                      shape of a single frame, e.g (3, 640, 640)
+        dtype       : numpy dtype
+                      data type of the frames
+        fields      : tuple
+                      names of the int64 index fields stored for every frame
+        """
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.fields = tuple(fields)
+        self.count = 0
+
+        with open(path + ".json", "w") as header_file:
+            json.dump({"dtype": self.dtype.str, "frame_shape": list(self.frame_shape), "fields": list(self.fields)}, header_file)
+
+        self._data = open(path + ".bin", "wb")
+        self._index = open(path + ".idx", "wb")
+
+    def append(self, frames, keys):
+        """
+        Append frames and their index fields to the store.
+        Parameters
+        ----------
+        frames      : numpy array
+                      array of shape (N,) + frame_shape, or a single frame of shape frame_shape
+        keys        : array like
+                      index fields of the frames, of shape (N, len(fields)) or (len(fields),)
+        """
+        frames = np.ascontiguousarray(frames, dtype=self.dtype).reshape((-1,) + self.frame_shape)
+        keys = np.ascontiguousarray(keys, dtype=np.int64).reshape(-1, len(self.fields))
+        assert frames.shape[0] == keys.shape[0], "Every frame needs exactly one row of index fields."
+
+        self._data.write(frames)
+        self._index.write(keys)
+        self.count += frames.shape[0]
+
+    def flush(self):
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AsyncFrameStoreWriter(FrameStoreWriter):
+
+    def __init__(self, path, frame_shape, dtype=np.float32, fields=("frame",), num_workers : int =1,
+                 max_pending : int =4, fsync : str ="close"):
+        """
+        Frame store writer whose appends only reserve a position in the store and hand the
+        frames to background writer threads, which write them with os.pwrite at that position.
+        Parameters
+        ----------
+        path        : str
+                      path of the store without extension, e.g "data/1/frames"
+        frame_shape : tuple
+                      shape of a single frame, e.g (3, 640, 640)
+        dtype       : numpy dtype
+                      data type of the frames
+        fields      : tuple
+                      names of the int64 index fields stored for every frame
+        num_workers : int
+                      number of writer threads
+        max_pending : int
+                      number of appends waiting for a writer before append blocks (backpressure)
+        fsync       : str
+                      "always" to fsync after every append, "close" to fsync once on close,
+                      "never" to leave flushing to the OS
+        """
+        assert fsync in ("always", "close", "never"), "fsync must be one of always, close or never."
+        super().__init__(path, frame_shape, dtype=dtype, fields=fields)
+        self.fsync = fsync
+        self.frame_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.key_nbytes = len(self.fields) * 8
+
+        self.write_time = 0.0   # wall-clock seconds at least one writer thread was writing
+        self.wait_time = 0.0    # seconds append blocked because max_pending appends were queued
+        self.drain_time = 0.0   # seconds close waited for the appends still queued
+        self._stats_lock = threading.Lock()
+        self._writing = 0       # writer threads writing right now, and since when one was
+        self._writing_since = 0.0
+        self._error = None
+
+        self._jobs = Queue(maxsize=max_pending)
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @staticmethod
+    def _pwrite(fd, array, offset):
+        view = memoryview(array).cast("B")
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            offset, frames, keys, source, on_done = job
+
+            with self._stats_lock:
+                if not self._writing:
+                    self._writing_since = time.perf_counter()
+                self._writing += 1
+            try:
+                if self._error is None:
+                    self._pwrite(self._data.fileno(), frames, offset * self.frame_nbytes)
+                    self._pwrite(self._index.fileno(), keys, offset * self.key_nbytes)
+                    if self.fsync == "always":
+                        os.fsync(self._data.fileno())
+                        os.fsync(self._index.fileno())
+            except Exception as e:
+                self._error = e
+            with self._stats_lock:
+                self._writing -= 1
+                if not self._writing:
+                    self.write_time += time.perf_counter() - self._writing_since
+
+            # frames are handed back even after an error, so that a producer waiting for them does not hang
+            if on_done is not None:
+                try:
+                    on_done(source)
+                except Exception as e:
+                    # the worker keeps draining the queue, append or close raise it
+                    if self._error is None:
+                        self._error = e
+
+    def append(self, frames, keys, on_done=None):
+        """
+        Reserve the next position in the store and queue the frames for writing.
+        `frames` must not be modified until the writer is done with it.
+        Parameters
+        ----------
+        frames      : numpy array
+                      array of shape (N,) + frame_shape, or a single frame of shape frame_shape
+        keys        : array like
+                      index fields of the frames, of shape (N, len(fields)) or (len(fields),)
+        on_done     : callable
+                      optional, called with `frames` by the writer thread once it is written,
+                      e.g to give a preallocated buffer back to its pool
+        """
+        if self._error is not None:
+            raise self._error
+
+        source = frames
+        frames = np.ascontiguousarray(frames, dtype=self.dtype).reshape((-1,) + self.frame_shape)
+        keys = np.ascontiguousarray(keys, dtype=np.int64).reshape(-1, len(self.fields))
+        assert frames.shape[0] == keys.shape[0], "Every frame needs exactly one row of index fields."
+
+        offset = self.count
+        self.count += frames.shape[0]
+
+        _start = time.perf_counter()
+        self._jobs.put((offset, frames, keys, source, on_done))
+        self.wait_time += time.perf_counter() - _start
+
+    def flush(self):
+        os.fsync(self._data.fileno())
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        """
+        Wait for every queued append to be written, then close the store.
+        """
+        _start = time.perf_counter()
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.drain_time = time.perf_counter() - _start
+
+        if self.fsync == "close" and self._error is None:
+            self.flush()
+        super().close()
+
+        if self._error is not None:
+            raise self._error
+
+    def report(self):
+        """
+        Time taken off the producing loop, the wall-clock time the writer threads were writing
+        minus the time the loop was blocked on them, in append (wait) or in close (drain).
+        The loop is blocked only while a write is running, so the rest overlapped it.
+        """
+        return {"write_time": self.write_time, "wait_time": self.wait_time, "drain_time": self.drain_time,
+                "saved_time": max(self.write_time - self.wait_time - self.drain_time, 0.0)}
+
+class FrameStore(object):
+
+    def __init__(self, path):
+        """
+        Open a frame store for reading, frames are memory-mapped and never loaded as a whole.
+        Parameters
+        ----------
+        path        : str
+                      path of the store without extension, e.g "data/1/frames"
+        """
+        with open(path + ".json") as header_file:
+            header = json.load(header_file)
+
+        self.path = path
+        self.dtype = np.dtype(header["dtype"])
+        self.frame_shape = tuple(header["frame_shape"])
+        self.fields = tuple(header["fields"])
+
+        # a partly written last frame of an interrupted run is ignored
+        frame_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        index = np.fromfile(path + ".idx", dtype=np.int64)
+        count = min(os.path.getsize(path + ".bin") // frame_nbytes, index.size // len(self.fields))
+
+        self.index = index[:count * len(self.fields)].reshape(count, len(self.fields))
+        if count:
+            self.frames = np.memmap(path + ".bin", dtype=self.dtype, mode="r", shape=(count,) + self.frame_shape)
+        else:
+            self.frames = np.empty((0,) + self.frame_shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, item):
+        """
+        Zero-copy view of a frame or a range of frames.
+        """
+        return self.frames[item]
+
+    def load(self, start=0, stop=None, out=None):
+        """
+        Load a range of frames as a float32 batch tensor, uint8 frames are normalized
+        to [0, 1] in the same pass that copies them out of the memory map.
+        Parameters
+        ----------
+        start       : int
+                      first frame of the batch
+        stop        : int
+                      frame after the last frame of the batch, end of the store if None
+        out         : numpy array
+                      optional float32 buffer of shape (stop - start,) + frame_shape to write into
+        
+        Returns
+        -------
+        batch       : numpy array
+                      float32 numpy array of shape (stop - start,) + frame_shape, or `out` if given
+        """
+        frames = self.frames[start:stop]
+        if out is None:
+            out = np.empty(frames.shape, dtype=np.float32)
+
+        if self.dtype == np.uint8:
+            np.divide(frames, np.float32(255.0), out=out, dtype=np.float32, casting="unsafe")
+        else:
+            np.copyto(out, frames, casting="unsafe")
+
+        return out
+
+    def field(self, name):
+        """
+        Values of index field `name` for every frame.
+        """
+        return self.index[:, self.fields.index(name)]
+
+def merge_stores(paths, path, remove : bool =True):
+    """
+    Concatenate frame stores of the same frame shape, dtype and index fields into a new store.
+    Parameters
+    ----------
+    paths       : list
+                  paths of the stores to concatenate, in order
+    path        : str
+                  path of the merged store
+    remove      : bool
+                  delete the files of the merged stores afterwards
+
+    Returns
+    -------
+    store       : FrameStore
+                  the merged store, opened for reading
+    """
+    parts = [FrameStore(part) for part in paths]
+    first = parts[0]
+    for part in parts[1:]:
+        assert (part.frame_shape, part.dtype, part.fields) == (first.frame_shape, first.dtype, first.fields), \
+            "Only stores with the same frame shape, dtype and index fields can be merged."
+
+    writer = FrameStoreWriter(path, first.frame_shape, dtype=first.dtype, fields=first.fields)
+    frame_nbytes = int(np.prod(first.frame_shape)) * first.dtype.itemsize
+    for part in parts:
+        # copy whole files, only the complete frames of a part are taken
+        with open(part.path + ".bin", "rb") as data_file:
+            _copy_bytes(data_file, writer._data, len(part) * frame_nbytes)
+        writer._index.write(np.ascontiguousarray(part.index))
+        writer.count += len(part)
+    writer.close()
+
+    if remove:
+        for part_path in paths:
+            for extension in (".json", ".bin", ".idx"):
+                os.remove(part_path + extension)
+
+    return FrameStore(path)
+
+def _copy_bytes(source, destination, nbytes, chunk_size=16 * 1024 * 1024):
+    while nbytes > 0:
+        chunk = source.read(min(chunk_size, nbytes))
+        if not chunk:
+            break
+        destination.write(chunk)
+        nbytes -= len(chunk)
@@ -0,0 +1,229 @@
+"""
+Per-frame latency tracing of the decode -> preprocess -> queue -> batch -> write pipeline
+
+Every frame is stamped with time.perf_counter() (system wide on Linux, so the stamps of the
+reader processes and of the multiplexer compare) when it enters each stage
+1. decode     : the reader starts decoding it
+2. acquire    : it is decoded, the reader waits for a free slot of its shared memory ring
+3. preprocess : it has a slot, preprocessing into it starts
+4. enqueue    : it is preprocessed and handed to the queue of its stream
+5. dequeue    : the multiplexer took it from the queue
+6. batch      : it is in a batch tensor, waiting for the batch to be flushed
+7. write      : its batch was handed to the frame store writer
+and once more when its batch is on disk ("done"). The latency of a stage is the time from entering
+it to entering the next one, "total" goes from decode to done.
+
+Latencies are not kept per frame but counted in HDR style histograms, one per stage and stream:
+log-linear buckets with a bounded relative error, O(1) to record a value and a few KB each however
+long the pipeline runs. They are dumped as JSON or in the Prometheus text format (e.g for the
+node_exporter textfile collector) at exit, or whenever the process gets SIGUSR1
+
+    kill -USR1 <pid>
+"""
+
+import os
+import json
+import math
+import atexit
+import signal
+import threading
+
+# stamps of a frame, in order
+STAGES = ("decode", "acquire", "preprocess", "enqueue", "dequeue", "batch", "write", "done")
+# histograms of a stream, the time spent in every stage and from decode to done
+LATENCIES = STAGES[:-1] + ("total",)
+# upper bounds of the Prometheus buckets, in seconds
+PROMETHEUS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class LatencyHistogram(object):
+
+    def __init__(self, significant_bits : int =7, unit : float =1e-6):
+        """
+        HDR style histogram of latencies. Values below 2 ** (significant_bits + 1) units get a bucket
+        each, above that every power of two is split in 2 ** significant_bits buckets, so a value
+        is known within a relative error of 2 ** -significant_bits (7 bits, < 0.8%) at any scale.
+        Parameters
+        ----------
+        significant_bits : int
+                           bits of a value that are kept
+        unit             : float
+                           smallest latency told apart, in seconds
+        """
+        self.significant_bits = significant_bits
+        self.unit = unit
+        self.counts = {}    # bucket index -> number of values, only buckets that were hit
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = max(int(seconds / self.unit), 0)
+        shift = max(value.bit_length() - self.significant_bits - 1, 0)
+        index = (shift << self.significant_bits) + (value >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def _bounds(self, index):
+        # lowest and highest value, in seconds, of the bucket at `index`
+        shift = max((index >> self.significant_bits) - 1, 0)
+        sub_bucket = index - (shift << self.significant_bits)
+        return (sub_bucket << shift) * self.unit, (((sub_bucket + 1) << shift) - 1) * self.unit
+
+    def merge(self, other):
+        """
+        Add the values of a histogram with the same significant_bits and unit.
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def buckets(self):
+        """
+        (upper bound in seconds, count) of every bucket that holds values, in increasing order.
+        """
+        return [(self._bounds(index)[1], self.counts[index]) for index in sorted(self.counts)]
+
+    def percentile(self, q):
+        """
+        Smallest bucket bound that q percent of the values are at or below, 0 if empty.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(math.ceil(q / 100 * self.count), 1)
+        seen = 0
+        for upper, count in self.buckets():
+            seen += count
+            if seen >= rank:
+                return min(upper, self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        """
+        Number of values at or below each of `bounds` (seconds), as Prometheus buckets count them.
+        A bucket counts as below a bound if its lowest value is, so a bound may take up to one bucket too many.
+        """
+        indexes = sorted(self.counts)
+        counts = []
+        seen = 0
+        i = 0
+        for bound in bounds:
+            while i < len(indexes) and self._bounds(indexes[i])[0] <= bound:
+                seen += self.counts[indexes[i]]
+                i += 1
+            counts.append(seen)
+        return counts
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0,
+                "min": self.min if self.count else 0.0, "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+                "p999": self.percentile(99.9), "buckets": self.buckets()}
+
+class FrameTracer(object):
+
+    def __init__(self, streams, significant_bits : int =7):
+        """
+        Latency histograms of every stage of every stream, fed with the stamps of whole frames.
+        record is thread safe, the frame store writer threads call it once a batch is written.
+        Parameters
+        ----------
+        streams          : list
+                           name of every stream, the label of its histograms
+        significant_bits : int
+                           precision of the histograms, see LatencyHistogram
+        """
+        self.streams = [str(stream) for stream in streams]
+        self.significant_bits = significant_bits
+        # histograms[latency][stream]
+        self.histograms = {latency: [LatencyHistogram(significant_bits) for _ in self.streams] for latency in LATENCIES}
+        self.frames = 0
+        self._lock = threading.Lock()
+
+    def record(self, stream, stamps):
+        """
+        Add one frame.
+        Parameters
+        ----------
+        stream      : int
+                      index of the stream of the frame
+        stamps      : sequence
+                      perf_counter time the frame entered every one of STAGES
+        """
+        stamps = [float(stamp) for stamp in stamps]
+        with self._lock:
+            for i, latency in enumerate(STAGES[:-1]):
+                self.histograms[latency][stream].record(stamps[i + 1] - stamps[i])
+            self.histograms["total"][stream].record(stamps[-1] - stamps[0])
+            self.frames += 1
+
+    def _snapshot(self):
+        # (latency, stream name, histogram) of every stream and of all of them merged, "all" first
+        snapshot = []
+        with self._lock:
+            for latency in LATENCIES:
+                merged = LatencyHistogram(self.significant_bits)
+                for histogram in self.histograms[latency]:
+                    merged.merge(histogram)
+                snapshot.append((latency, "all", merged))
+                for stream, histogram in zip(self.streams, self.histograms[latency]):
+                    snapshot.append((latency, stream, LatencyHistogram(self.significant_bits).merge(histogram)))
+        return snapshot
+
+    def report(self):
+        """
+        Count, mean, min, max, percentiles and buckets of every latency, per stream and for "all".
+        """
+        report = {"frames": self.frames, "stages": {}}
+        for latency, stream, histogram in self._snapshot():
+            report["stages"].setdefault(latency, {})[stream] = histogram.to_dict()
+        return report
+
+    def to_prometheus(self, name : str ="asynccv_frame_latency_seconds"):
+        """
+        The histograms in the Prometheus text exposition format, labelled by stage and stream.
+        """
+        lines = ["# HELP {} Time a frame spent in a stage of the pipeline.".format(name),
+                 "# TYPE {} histogram".format(name)]
+        for latency, stream, histogram in self._snapshot():
+            if stream == "all":
+                continue  # Prometheus sums over streams itself
+            labels = 'stage="{}",stream="{}"'.format(latency, stream)
+            for bound, count in zip(PROMETHEUS_BUCKETS, histogram.cumulative(PROMETHEUS_BUCKETS)):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, histogram.count))
+            lines.append("{}_sum{{{}}} {}".format(name, labels, histogram.sum))
+            lines.append("{}_count{{{}}} {}".format(name, labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Write the histograms to `path`, in the Prometheus text format if it ends with .prom,
+        as JSON otherwise. The file is replaced at once, a reader never sees half of it.
+        """
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.report(), indent=2)
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path + ".tmp", "w") as dump_file:
+            dump_file.write(text)
+        os.replace(path + ".tmp", path)
+
+    def dump_on(self, path, signum=signal.SIGUSR1):
+        """
+        Dump to `path` when the process exits and whenever it receives `signum`.
+        Call it from the main thread, after the reader processes were started.
+        """
+        atexit.register(self.dump, path)
+        # the handler runs between two bytecodes of the main thread, which may hold the lock, so dump from a thread
+        signal.signal(signum, lambda *_: threading.Thread(target=self.dump, args=(path,)).start())
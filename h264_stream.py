@@ -0,0 +1,307 @@
+"""
+Split a raw H.264 Annex-B byte stream, as written by ffmpeg -f h264, into access units
+
+ffmpeg's pipe is read in large chunks, which cut NAL units anywhere. AccessUnitParser keeps
+the tail of the stream that is not complete yet and emits whole access units (every NAL unit
+of one frame, from its AUD / SPS / PPS / SEI up to its last slice) with a keyframe flag,
+so downstream stages work per frame instead of per chunk of bytes.
+
+An access unit starts at
+1. an access unit delimiter, SPS, PPS or SEI NAL unit following a slice, or
+2. a slice whose first_mb_in_slice is 0 following a slice.
+It is a keyframe if it holds an IDR slice, or if its first slice is an I slice and it has a recovery
+point SEI, the random access points of the many CCTV encoders that never send IDR frames.
+
+With a BufferPool, access units are copied into recycled bytearrays instead of new bytes objects,
+the consumer gives every one of them back with pool.release once it is done with it, and the pipe
+is read with readinto into a preallocated chunk, so a running camera allocates nothing per frame.
+"""
+
+import threading
+
+START_CODE = b"\x00\x00\x01"
+
+# nal_unit_type values
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# non-VCL NAL units that may only come before the first slice of an access unit
+_AU_PREFIX = {NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD, 14, 15, 16, 17, 18}
+# SEI payloadType of a recovery point
+SEI_RECOVERY_POINT = 6
+
+def _recovery_point(payload):
+    # True if the SEI messages of an SEI NAL unit (without its header byte) hold a recovery point
+    data = bytes(payload).replace(b"\x00\x00\x03", b"\x00\x00").rstrip(b"\x00")
+    i = 0
+    while i < len(data) - 1:    # the last byte holds the rbsp trailing bits
+        values = []
+        for _ in range(2):      # payloadType, then payloadSize, both coded as 0xFF bytes and a last byte
+            value = 0
+            while i < len(data) and data[i] == 0xFF:
+                value += 255
+                i += 1
+            if i >= len(data):
+                return False
+            values.append(value + data[i])
+            i += 1
+        payload_type, payload_size = values
+        if payload_type == SEI_RECOVERY_POINT:
+            return True
+        i += payload_size
+    return False
+
+def _intra(byte):
+    # True if a slice whose first_mb_in_slice is 0 is an I or SI slice, from the byte after its header:
+    # ue(v) "1" for first_mb_in_slice then ue(v) slice_type, at most 7 bits for the valid slice types
+    bits = byte & 0x7F
+    zeros = 0
+    while zeros < 3 and not bits & (0x40 >> zeros):
+        zeros += 1
+    slice_type = ((bits >> (6 - 2 * zeros)) & ((1 << (zeros + 1)) - 1)) - 1
+    return slice_type % 5 in (2, 4)
+
+def parameter_sets(unit):
+    """
+    SPS and PPS NAL units of an access unit, which only come before its first slice.
+    Parameters
+    ----------
+    unit        : bytes like
+                  an access unit, as emitted by AccessUnitParser
+
+    Returns
+    -------
+    nal_units   : list
+                  (nal_unit_type, NAL unit bytes with a 4 byte start code, as Annex B wants before
+                  parameter sets) of every SPS and PPS, in stream order
+    """
+    data = bytes(unit)
+    starts = []
+    position = data.find(START_CODE)
+    while 0 <= position < len(data) - 3:
+        starts.append(position)
+        if data[position + 3] & 0x1F in (NAL_SLICE, NAL_IDR):
+            break  # nothing but slices follow
+        position = data.find(START_CODE, position + 3)
+
+    nal_units = []
+    for start, stop in zip(starts, starts[1:]):
+        nal_type = data[start + 3] & 0x1F
+        if nal_type in (NAL_SPS, NAL_PPS):
+            # a 4 byte start code of the next NAL unit leaves a zero byte at the end
+            nal_units.append((nal_type, b"\x00" + START_CODE + data[start + 3:stop].rstrip(b"\x00")))
+    return nal_units
+
+def delimiter_length(unit):
+    """
+    Length of the access unit delimiter an access unit starts with, which must stay its first NAL unit.
+    Parameters
+    ----------
+    unit        : bytes like
+                  an access unit, as emitted by AccessUnitParser
+
+    Returns
+    -------
+    length      : int
+                  bytes up to the NAL unit after the AUD, 0 if the access unit has no AUD
+    """
+    head = bytes(unit[:64])     # start code, header and primary_pic_type, a few trailing zeros at most
+    position = head.find(START_CODE)
+    if position < 0 or position + 3 >= len(head) or head[position + 3] & 0x1F != NAL_AUD:
+        return 0
+    stop = head.find(START_CODE, position + 3)
+    if stop < 0:
+        return 0
+    # a 4 byte start code of the next NAL unit stays with it
+    return stop - 1 if head[stop - 1] == 0 else stop
+
+class BufferPool(object):
+
+    def __init__(self, buffer_size : int =256 * 1024):
+        """
+        Recycled bytearrays for access units, shared by any number of readers and consumers.
+        Parameters
+        ----------
+        buffer_size : int
+                      smallest buffer allocated, larger access units get the next power of two
+        """
+        self.buffer_size = buffer_size
+        self._free = []
+        self._lock = threading.Lock()
+        self.allocated = 0          # buffers ever allocated, constant once the pool is warm
+        self.allocated_bytes = 0
+        self.reused = 0             # acquires served by a released buffer
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def acquire(self, size):
+        """
+        A buffer of at least `size` bytes, a released one if any is large enough.
+        """
+        with self._lock:
+            for i in range(len(self._free) - 1, -1, -1):
+                if len(self._free[i]) >= size:
+                    buffer = self._free.pop(i)
+                    self.reused += 1
+                    break
+            else:
+                capacity = self.buffer_size
+                while capacity < size:
+                    capacity *= 2
+                buffer = bytearray(capacity)
+                self.allocated += 1
+                self.allocated_bytes += capacity
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return buffer
+
+    def release(self, unit):
+        """
+        Give a buffer back, `unit` is the buffer or the memoryview of an access unit in it.
+        """
+        if isinstance(unit, memoryview):
+            buffer = unit.obj
+            unit.release()
+        else:
+            buffer = unit
+        with self._lock:
+            self._free.append(buffer)
+            self.in_use -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"allocated": self.allocated, "allocated_bytes": self.allocated_bytes, "reused": self.reused,
+                    "in_use": self.in_use, "peak_in_use": self.peak_in_use}
+
+class AccessUnitParser(object):
+
+    def __init__(self, pool=None):
+        """
+        Incremental Annex-B parser, feed() it chunks of any size, in stream order.
+        Parameters
+        ----------
+        pool        : BufferPool
+                      access units are emitted as memoryviews of buffers of the pool, which
+                      the consumer must release, instead of as bytes if None
+        """
+        self.pool = pool
+        self._buffer = bytearray()
+        self._scan = 0          # where the next start code search begins
+        self._seen_vcl = False  # the current access unit already has a slice
+        self._keyframe = False  # the current access unit has an IDR slice
+        self._intra = False     # the first slice of the current access unit is an I slice
+        self._recovery = False  # the current access unit has a recovery point SEI
+        self._sei = -1          # buffer position of an SEI NAL unit whose end was not found yet
+        self.units = 0          # access units emitted
+        self.keyframes = 0      # keyframes emitted
+
+    def feed(self, data):
+        """
+        Append a chunk of the stream.
+        Parameters
+        ----------
+        data        : bytes like
+                      next bytes of the stream, copied, may be reused once feed returns
+
+        Returns
+        -------
+        units       : list
+                      (access unit, keyframe) of every access unit completed by `data`
+        """
+        buffer = self._buffer
+        buffer += data
+        units = []
+        start = 0               # start of the current access unit in the buffer
+
+        while True:
+            position = buffer.find(START_CODE, self._scan)
+            if position < 0:
+                # a start code may be split across chunks, search its first bytes again next time
+                self._scan = max(self._scan, len(buffer) - 2)
+                break
+            # the header byte, and for slices the first byte of the slice header, are needed
+            if position + 4 >= len(buffer):
+                self._scan = position
+                break
+            self._scan = position + 3
+
+            if self._sei >= 0:
+                # the SEI NAL unit ends here, it is only parsed whole
+                self._recovery = self._recovery or _recovery_point(buffer[self._sei + 4:position])
+                self._sei = -1
+
+            header = buffer[position + 3]
+            nal_type = header & 0x1F
+            is_vcl = nal_type == NAL_SLICE or nal_type == NAL_IDR
+
+            if self._seen_vcl and (nal_type in _AU_PREFIX or
+                                   (is_vcl and buffer[position + 4] & 0x80)):  # first_mb_in_slice == 0, ue(v) "1"
+                # a 4 byte start code belongs to the next access unit
+                nal_start = position - 1 if position > start and buffer[position - 1] == 0 else position
+                units.append((self._unit(buffer, start, nal_start), self._is_keyframe()))
+                start = nal_start
+                self._seen_vcl = False
+                self._keyframe = False
+                self._intra = False
+                self._recovery = False
+
+            if nal_type == NAL_SEI:
+                self._sei = position
+            if is_vcl:
+                if not self._seen_vcl:
+                    self._intra = nal_type == NAL_SLICE and _intra(buffer[position + 4])
+                self._seen_vcl = True
+                self._keyframe = self._keyframe or nal_type == NAL_IDR
+
+        if start:
+            del buffer[:start]
+            self._scan -= start
+            if self._sei >= 0:
+                self._sei -= start
+
+        self.units += len(units)
+        self.keyframes += sum(keyframe for _, keyframe in units)
+        return units
+
+    def _is_keyframe(self):
+        # The current access unit can be decoded on its own, an IDR or a recovery point I frame
+        return self._keyframe or (self._intra and self._recovery)
+
+    def _unit(self, buffer, start, stop):
+        # Copy an access unit out of the parse buffer, a view is released at once so that the buffer can shrink
+        with memoryview(buffer) as view:
+            if self.pool is None:
+                return bytes(view[start:stop])
+            unit = self.pool.acquire(stop - start)
+            unit[:stop - start] = view[start:stop]
+        return memoryview(unit)[:stop - start]
+
+    def flush(self):
+        """
+        End of the stream, emit the last access unit.
+
+        Returns
+        -------
+        units       : list
+                      (access unit, keyframe) of the last access unit, empty if nothing is left
+        """
+        units = []
+        if self._sei >= 0:
+            self._recovery = self._recovery or _recovery_point(self._buffer[self._sei + 4:])
+        if self._buffer:
+            keyframe = self._is_keyframe()
+            units.append((self._unit(self._buffer, 0, len(self._buffer)), keyframe))
+            self.units += 1
+            self.keyframes += int(keyframe)
+        self._buffer = bytearray()
+        self._scan = 0
+        self._seen_vcl = False
+        self._keyframe = False
+        self._intra = False
+        self._recovery = False
+        self._sei = -1
+        return units
@@ -1,74 +1,445 @@
+import os
 import numpy as np
 import subprocess as sp
+import selectors
 import threading
 import queue
 import time
 
+from ffmpeg_source import FFmpegVideoCapture
+from h264_stream import AccessUnitParser, BufferPool, parameter_sets, delimiter_length, NAL_SPS, NAL_PPS
+
+def copy_command(in_stream, realtime : bool =False):
+    # ffmpeg command writing the H.264 stream of a camera to its stdout as is
+    command = ["ffmpeg", "-loglevel", "error", "-nostdin"]
+    if realtime:
+        command += ["-re"]              # Read a file input at its native frame rate, like a camera sends it
+    command += ["-c:v", "h264",         # Tell FFmpeg that input stream codec is h264
+                "-i", in_stream,        # Read stream from file vid.264
+                "-c:v", "copy",         # Tell FFmpeg to copy the video stream as is (without decoding and encoding)
+                "-an", "-sn",           # No audio an no subtitles
+                "-f", "h264",           # Define pipe format to be h264
+                "-"]                    # Output is a pipe
+    return command
+
 class CCTVReader(threading.Thread):
-    def __init__(self, q, in_stream, chunk_size):
+    def __init__(self, q, in_stream, chunk_size : int =1024**2, max_units=None, realtime : bool =False, pool=None):
+        # q receives (access unit bytes, keyframe) per frame of the stream, see AccessUnitParser
+        # chunk_size is the most bytes a single read takes from the pipe, whatever is available is read at once
+        # max_units stops the reader after that many access units (for testing), None reads until the stream ends
+        # realtime reads a file input at its frame rate, like a camera would send it
+        # pool (h264_stream.BufferPool) makes access units memoryviews of pooled buffers, to be released by the consumer
         super().__init__()
         self.q = q
         self.chunk_size = chunk_size
-        self.command = ["ffmpeg",
-                        "-c:v", "h264",     # Tell FFmpeg that input stream codec is h264
-                        "-i", in_stream,    # Read stream from file vid.264
-                        "-c:v", "copy",     # Tell FFmpeg to copy the video stream as is (without decoding and encoding)
-                        "-an", "-sn",       # No audio an no subtitles
-                        "-f", "h264",       # Define pipe format to be h264
-                        "-"]                # Output is a pipe
+        self.max_units = max_units
+        self.parser = AccessUnitParser(pool=pool)
+        self._chunk = bytearray(chunk_size)  # every read goes into this one buffer
+        self.command = copy_command(in_stream, realtime=realtime)
 
     def run(self):
-        pipe = sp.Popen(self.command, stdout=sp.PIPE, bufsize=1024**3)  # Don't use shell=True (you don't need to execute the command through the shell).
-
-        # while True:
-        for i in range(100):  # Read up to 100KBytes for testing
-            data = pipe.stdout.read(self.chunk_size)  # Read data from pip in chunks of self.chunk_size bytes
-            self.q.put(data)
+        # Don't use shell=True (you don't need to execute the command through the shell).
+        # unbuffered, readinto() reads from the pipe straight into self._chunk
+        pipe = sp.Popen(self.command, stdout=sp.PIPE, bufsize=0)
+        chunk = memoryview(self._chunk)
 
-            # Break loop if less than self.chunk_size bytes read (not going to work with CCTV, but works with input file)
-            if len(data) < self.chunk_size:
+        while self.max_units is None or self.parser.units < self.max_units:
+            count = pipe.stdout.readinto(chunk)  # Read whatever the pipe holds, up to self.chunk_size bytes at once
+            if not count:
+                # End of stream (not going to happen with CCTV, but happens with input file)
+                for unit in self.parser.flush():
+                    self.q.put(unit)
                 break
 
+            # one put per whole frame instead of one per chunk, no NAL unit is cut in half
+            for unit in self.parser.feed(chunk[:count]):
+                self.q.put(unit)
+
         try:
             pipe.wait(timeout=1)  # Wait for subprocess to finish (with timeout of 1 second).
         except sp.TimeoutExpired:
             pipe.kill()           # Kill subprocess in case of a timeout (there should be a timeout because input stream still lives).
 
 
+class SegmentRecorder(threading.Thread):
+    def __init__(self, q, folder, prefix : str ="segment", max_bytes : int =64 * 1024**2, max_seconds=None,
+                 max_segments=10, write_buffer : int =1024**2, pool=None, max_skipped : int =300):
+        """
+        Write the access units of a camera to disk as they come, in rolling segment files
+        folder/prefix-00000.264, folder/prefix-00001.264, ... instead of keeping the recording in memory.
+        A new segment starts at the first keyframe (IDR or recovery point I frame) after the current one
+        reached max_bytes or max_seconds, so that every segment can be played on its own. Access units
+        before the first keyframe are skipped, and the latest SPS / PPS seen with a keyframe are written
+        at the start of every segment whose first keyframe does not carry them (after its AUD, SPS first),
+        for cameras that only send them once.
+        Put None on q to stop.
+        Parameters
+        ----------
+        q            : queue.Queue
+                       (access unit, keyframe) of a camera, e.g filled by a CCTVReader
+        folder       : str
+                       folder of the segment files
+        prefix       : str
+                       name of the segment files
+        max_bytes    : int
+                       size of a segment, None for no size limit
+        max_seconds  : float
+                       duration of a segment, None for no time limit
+        max_segments : int
+                       number of segments kept, older ones are deleted, None to keep every segment
+        write_buffer : int
+                       size of the file buffer, access units are written to disk in writes of this size
+        pool         : h264_stream.BufferPool
+                       pool the access units come from, they are released once written
+        max_skipped  : int
+                       access units skipped before a warning that the camera sent no keyframe,
+                       a few GOPs' worth, None for no warning
+        """
+        super().__init__()
+        self.q = q
+        self.folder = folder
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_segments = max_segments
+        self.write_buffer = write_buffer
+        self.pool = pool
+        self.max_skipped = max_skipped
+
+        self.segments = []      # paths of the segments on disk, oldest first
+        self.units = 0          # access units written
+        self.bytes = 0          # bytes written
+        self.deleted = 0        # segments rotated out
+        self.skipped = 0        # access units before the first keyframe, not decodable on their own
+        self._parameter_sets = {}  # latest SPS and PPS NAL units, by nal_unit_type
+        self._file = None
+        self._count = 0         # segments started
+        self._segment_bytes = 0
+        self._segment_start = 0.0
+
+    def _due(self):
+        # The current segment is full, a new one starts at the next keyframe
+        return (self.max_bytes is not None and self._segment_bytes >= self.max_bytes) or \
+               (self.max_seconds is not None and time.monotonic() - self._segment_start >= self.max_seconds)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._segment_bytes += len(data)
+        self.bytes += len(data)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+
+        path = os.path.join(self.folder, "{}-{:05d}.264".format(self.prefix, self._count))
+        self._file = open(path, "wb", buffering=self.write_buffer)
+        self._count += 1
+        self._segment_bytes = 0
+        self._segment_start = time.monotonic()
+        self.segments.append(path)
+
+        while self.max_segments is not None and len(self.segments) > self.max_segments:
+            os.remove(self.segments.pop(0))
+            self.deleted += 1
+
+    def run(self):
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            while True:
+                unit = self.q.get()
+                if unit is None:
+                    break
+                data, keyframe = unit
+
+                if self._file is None and not keyframe:
+                    self.skipped += 1
+                    if self.skipped == self.max_skipped:
+                        print("{} : no keyframe in {} access units, nothing is recorded yet".format(
+                            self.folder, self.skipped))
+                    if self.pool is not None:
+                        self.pool.release(data)
+                    continue
+
+                carried = {}
+                if keyframe:
+                    for nal_type, nal_unit in parameter_sets(data):
+                        carried[nal_type] = carried.get(nal_type, b"") + nal_unit
+                    self._parameter_sets.update(carried)
+
+                head = 0        # bytes of the access unit already written
+                if self._file is None or (keyframe and self._due()):
+                    self._rotate()
+                    if NAL_SPS not in carried or NAL_PPS not in carried:
+                        # the segment must start with parameter sets, the stream may have sent them only once.
+                        # They go after the AUD, which must stay first, SPS before PPS, the carried ones too
+                        # (an identical SPS / PPS may be repeated) so that no PPS comes before its SPS
+                        head = delimiter_length(data)
+                        self._write(data[:head])
+                        for nal_type in (NAL_SPS, NAL_PPS):
+                            if nal_type in self._parameter_sets:
+                                self._write(self._parameter_sets[nal_type])
+                self._write(data[head:])
+                self.units += 1
+
+                if self.pool is not None:
+                    self.pool.release(data)
+        finally:
+            if self._file is not None:
+                self._file.close()
+
+class FrameMailbox(object):
+    def __init__(self, frame_shape, dtype=np.uint8):
+        """
+        Single-slot mailbox holding only the most recent frame of a live camera.
+        A new frame overwrites the one waiting in the slot (counted as dropped), so a slow
+        consumer always gets the freshest frame, latency stays bounded and memory constant.
+        Triple buffered, the writer fills the back buffer while the consumer works on the
+        front buffer, so frames are never copied and never allocated.
+        Parameters
+        ----------
+        frame_shape : tuple
+                      shape of a frame, e.g (height, width, 3)
+        dtype       : numpy dtype
+                      data type of the frames
+        """
+        self._buffers = [np.empty(frame_shape, dtype=dtype) for _ in range(3)]
+        self._seqs = [-1, -1, -1]
+        self._back, self._middle, self._front = 0, 1, 2
+        self._fresh = False
+        self._cond = threading.Condition()
+        self.closed = False
+        self.written = 0    # frames published by the writer
+        self.dropped = 0    # frames overwritten before the consumer took them
+
+    def back(self):
+        # Buffer the writer fills next, only the writer thread may touch it
+        return self._buffers[self._back]
+
+    def publish(self):
+        # Make the back buffer the newest frame, a frame still waiting in the slot is dropped
+        with self._cond:
+            self._seqs[self._back] = self.written
+            self._back, self._middle = self._middle, self._back
+            if self._fresh:
+                self.dropped += 1
+            self._fresh = True
+            self.written += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait for a frame newer than the last one taken.
+
+        Returns
+        -------
+        seq         : int
+                      number of the frame in the stream, gaps are dropped frames
+        frame       : numpy array
+                      the frame, valid until the next get()
+        None is returned instead once the mailbox is closed or on timeout
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fresh or self.closed, timeout):
+                return None
+            if not self._fresh:
+                return None
+            self._middle, self._front = self._front, self._middle
+            self._fresh = False
+            return self._seqs[self._front], self._buffers[self._front]
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+class CCTVFrameReader(threading.Thread):
+    def __init__(self, in_stream, width=None, height=None):
+        # Decode a live stream into a FrameMailbox (self.mailbox), only the latest frame is kept
+        super().__init__(daemon=True)
+        if width is None or height is None:
+            width, height = FFmpegVideoCapture.probe(in_stream)
+        self.in_stream = in_stream
+        self.width = width
+        self.height = height
+        self.mailbox = FrameMailbox((height, width, 3), dtype=np.uint8)
+        self._stopping = threading.Event()
+
+    def run(self):
+        # frames are decoded straight into the mailbox's back buffer
+        vidcap = FFmpegVideoCapture(self.in_stream, num_buffers=1, width=self.width, height=self.height)
+        try:
+            while not self._stopping.is_set():
+                if not vidcap.readinto(self.mailbox.back()):
+                    break
+                self.mailbox.publish()
+        finally:
+            vidcap.release()
+            self.mailbox.close()
+
+    def stop(self):
+        self._stopping.set()
+
+
+class CCTVMultiplexer(threading.Thread):
+    def __init__(self, chunk_size : int =1024**2, max_units=None, realtime : bool =False, pool=None, metrics=None):
+        """
+        Read the pipes of many cameras from a single thread, instead of a CCTVReader thread
+        blocking on every pipe. The pipes are non-blocking and registered with a selector,
+        only the pipes that hold data are read, each into the AccessUnitParser of its camera.
+        Every camera is added before start(), the thread ends once all of them ended or stop() is called.
+        Access units are handed over with put_nowait, a full queue never stalls the other cameras,
+        its camera drops access units up to its next keyframe instead, so what it does get stays decodable.
+        Parameters
+        ----------
+        chunk_size  : int
+                      most bytes a single read takes from a pipe
+        max_units   : int
+                      stop reading a camera after that many access units (for testing),
+                      None reads until its stream ends
+        realtime    : bool
+                      read file inputs at their frame rate, like cameras would send them
+        pool        : h264_stream.BufferPool
+                      access units are memoryviews of pooled buffers, released by the consumer,
+                      instead of bytes if given
+        metrics     : queue_metrics.QueueMetrics
+                      optional, counts the access units handed over (produced) and dropped by every camera,
+                      camera i is stream i of the metrics, in the order they were added
+        """
+        super().__init__(daemon=True)
+        self.chunk_size = chunk_size
+        self.max_units = max_units
+        self.realtime = realtime
+        self.pool = pool
+        self.metrics = metrics
+        self._chunk = bytearray(chunk_size)  # a single thread reads every pipe, one read buffer is enough
+        self.selector = selectors.DefaultSelector()
+        self._cameras = []
+        self._stopping = threading.Event()
+        self.dropped = []  # access units dropped by every camera because its queue was full
+
+    def add(self, q, in_stream):
+        # Start a camera, q receives (access unit bytes, keyframe) per frame like with CCTVReader.
+        # Only before start(), the selector thread owns the cameras once it runs
+        if self.ident is not None:
+            raise RuntimeError("Cameras must be added before the multiplexer is started.")
+        pipe = sp.Popen(copy_command(in_stream, realtime=self.realtime), stdin=sp.DEVNULL, stdout=sp.PIPE, bufsize=0)
+        os.set_blocking(pipe.stdout.fileno(), False)
+        # queue, pipe, parser, camera index, dropping up to the next keyframe
+        camera = [q, pipe, AccessUnitParser(pool=self.pool), len(self.dropped), False]
+        self._cameras.append(camera)
+        self.dropped.append(0)
+        self.selector.register(pipe.stdout.fileno(), selectors.EVENT_READ, camera)
+
+    def start(self):
+        if not self._cameras:
+            raise RuntimeError("Add at least one camera before starting the multiplexer.")
+        super().start()
+
+    def _hand_over(self, camera, unit):
+        # put_nowait an access unit, a camera whose queue is full drops units until its next keyframe
+        q, _, _, index, dropping = camera
+        if not dropping or unit[1]:
+            try:
+                q.put_nowait(unit)
+                camera[4] = False
+                if self.metrics is not None:
+                    self.metrics.produced(index)
+                return
+            except queue.Full:
+                pass
+        camera[4] = True
+        self.dropped[index] += 1
+        if self.metrics is not None:
+            self.metrics.dropped(index)
+        if self.pool is not None:
+            self.pool.release(unit[0])
+
+    def _close(self, camera):
+        q, pipe, parser, _, _ = camera
+        self.selector.unregister(pipe.stdout.fileno())
+        self._cameras.remove(camera)
+        pipe.stdout.close()
+        if pipe.poll() is None:
+            pipe.kill()  # a live stream never ends on its own
+        pipe.wait()
+
+    def run(self):
+        chunk = memoryview(self._chunk)
+        try:
+            while self._cameras and not self._stopping.is_set():
+                for key, _ in self.selector.select(timeout=0.1):
+                    camera = key.data
+                    pipe, parser = camera[1], camera[2]
+                    count = pipe.stdout.readinto(chunk)
+                    if count is None:
+                        continue  # nothing to read after all
+
+                    units = parser.feed(chunk[:count]) if count else parser.flush()  # empty read is the end of the stream
+                    for unit in units:
+                        self._hand_over(camera, unit)
+                    if not count or (self.max_units is not None and parser.units >= self.max_units):
+                        self._close(camera)
+        finally:
+            for camera in list(self._cameras):
+                self._close(camera)
+            self.selector.close()
+
+    def stop(self):
+        self._stopping.set()
+
+
+if __name__ == "__main__":
+    #in_stream = "rtsp://xxx.xxx.xxx.xxx:xxx/Streaming/Channels/101?transportmode=multicast",
+
+    #Use public RTSP Streaming for testing
+    in_stream1 = "rtsp://wowzaec2demo.streamlock.net/vod/mp4:BigBuckBunny_115k.mov"
+
+    in_stream2 = "rtsp://wowzaec2demo.streamlock.net/vod/mp4:BigBuckBunny_115k.mov"
+
 
-#in_stream = "rtsp://xxx.xxx.xxx.xxx:xxx/Streaming/Channels/101?transportmode=multicast",
+    q1 = queue.Queue(maxsize=256)  # Bounded, a reader waits for a recorder slower than the camera instead of filling the RAM
+    q2 = queue.Queue(maxsize=256)
 
-#Use public RTSP Streaming for testing
-in_stream1 = "rtsp://wowzaec2demo.streamlock.net/vod/mp4:BigBuckBunny_115k.mov"
+    pool = BufferPool()  # Access units of both streams in recycled buffers
 
-in_stream2 = "rtsp://wowzaec2demo.streamlock.net/vod/mp4:BigBuckBunny_115k.mov"
+    cctv_reader1 = CCTVReader(q1, in_stream1, max_units=100, pool=pool)  # First stream, 100 frames for testing
+    cctv_reader2 = CCTVReader(q2, in_stream2, max_units=100, pool=pool)  # Second stream
 
+    # Write the streams to disk while they come, 10 seconds per segment file, the last hour is kept
+    recorder1 = SegmentRecorder(q1, "recordings/1", max_seconds=10, max_segments=360, pool=pool)
+    recorder2 = SegmentRecorder(q2, "recordings/2", max_seconds=10, max_segments=360, pool=pool)
+    recorder1.start()
+    recorder2.start()
 
-q1 = queue.Queue()
-q2 = queue.Queue()
+    cctv_reader1.start()
+    time.sleep(5) # Wait 5 seconds (for testing).
+    cctv_reader2.start()
 
-cctv_reader1 = CCTVReader(q1, in_stream1, 1024)  # First stream 
-cctv_reader2 = CCTVReader(q2, in_stream2, 2048)  # Second stream
+    cctv_reader1.join()
+    cctv_reader2.join()
 
-cctv_reader1.start()
-time.sleep(5) # Wait 5 seconds (for testing).
-cctv_reader2.start()
+    q1.put(None)
+    q2.put(None)
+    recorder1.join()
+    recorder2.join()
 
-cctv_reader1.join()
-cctv_reader2.join()
+    for recorder in [recorder1, recorder2]:
+        if recorder.units == 0:
+            print("There is a problem ({} is empty)!!!".format(recorder.folder))
+        else:
+            print("{} : {} frames, {} bytes in {}".format(recorder.folder, recorder.units, recorder.bytes, recorder.segments))
 
-if q1.empty():
-    print("There is a problem (q1 is empty)!!!")
-else:
-    # Write data from queue to file vid_from_queue1.264 (for testing)
-    with open("vid_from_q1.264", "wb") as queue_save_file:
-        while not q1.empty():
-            queue_save_file.write(q1.get())
+    print("Buffer pool : {}".format(pool.stats()))
 
-if q2.empty():
-    print("There is a problem (q2 is empty)!!!")
-else:
-    # Write data from queue to file vid_from_queue2.264 (for testing)
-    with open("vid_from_q2.264", "wb") as queue_save_file:
-        while not q2.empty():
-            queue_save_file.write(q2.get())
\ No newline at end of file
+    # Latest frame only, a consumer slower than the camera gets the freshest frame instead of a backlog
+    frame_reader = CCTVFrameReader(in_stream1)
+    frame_reader.start()
+    for i in range(10):
+        latest = frame_reader.mailbox.get(timeout=5)
+        if latest is None:
+            break
+        seq, frame = latest
+        time.sleep(0.2)  # Slow consumer (for testing)
+    frame_reader.stop()
+    frame_reader.join()
+    print("Mailbox : {} frames decoded, {} dropped".format(frame_reader.mailbox.written, frame_reader.mailbox.dropped))
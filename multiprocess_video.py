@@ -1,6 +1,10 @@
 import os
+import json
+import time
+import functools
 import multiprocessing
-from subprocess import Popen, PIPE, STDOUT
+from fractions import Fraction
+from subprocess import Popen, PIPE, STDOUT, CalledProcessError, check_output
 
 from tqdm import tqdm
 
@@ -21,11 +25,59 @@ def extract_frames_ffmpeg(info):
 
     print("Extracting frames from {:s} done!".format(abs_video_path))
 
-def extract(infos):
+def probe_video(info):
+    # Estimate the decoding cost of a video as its number of frames,
+    # from the container when it knows it, otherwise from duration * frame rate
+    abs_video_path = os.path.abspath(info[0])
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "stream=nb_frames,r_frame_rate:format=duration", "-of", "json", abs_video_path]
+    try:
+        meta = json.loads(check_output(command))
+    except (CalledProcessError, OSError, ValueError):
+        return 0.0, 0, 0.0
+
+    stream = (meta.get("streams") or [{}])[0]
+    duration = float(meta.get("format", {}).get("duration", 0) or 0)
+    frames = int(stream["nb_frames"]) if str(stream.get("nb_frames", "")).isdigit() else 0
+    if not frames:
+        try:
+            fps = float(Fraction(stream.get("r_frame_rate", "0")))
+        except (ValueError, ZeroDivisionError):
+            fps = 0.0
+        frames = int(duration * fps)
+
+    return duration, frames, float(frames or duration)
+
+def timed_call(fn, info):
+    # Run fn(info) in a pool worker and report which worker ran it and when
+    start = time.time()
+    fn(info)
+    return info, os.getpid(), start, time.time()
+
+def schedule(fn, infos, processes : int =4):
+    # Run fn over every video, longest first, each worker picks up the next video as soon as it
+    # is free, so a long video starts early instead of becoming the straggler at the end
+    with multiprocessing.Pool(processes=processes) as pool:
+        costs = pool.map(probe_video, infos)
+        order = sorted(range(len(infos)), key=lambda i: costs[i][2], reverse=True)
+        for i in order:
+            print("Scheduled {} : {:.1f}s, {} frames".format(infos[i][0], costs[i][0], costs[i][1]))
+
+        start = time.time()
+        busy = {}
+        for info, pid, begin, end in pool.imap_unordered(functools.partial(timed_call, fn), [infos[i] for i in order], chunksize=1):
+            busy[pid] = busy.get(pid, 0.0) + end - begin
+        makespan = time.time() - start
+
+    for pid, busy_time in sorted(busy.items()):
+        print("Worker {} : busy {:.2f}s of {:.2f}s ({:.0f}%)".format(pid, busy_time, makespan, 100 * busy_time / max(makespan, 1e-9)))
+    print("{} of {} workers used, utilization {:.0f}%".format(len(busy), processes, 100 * sum(busy.values()) / max(makespan * processes, 1e-9)))
+
+    return makespan
+
+def extract(infos, processes : int =4):
     try:
-        with multiprocessing.Pool(processes=4) as pool:
-            pool.map(extract_frames_ffmpeg, infos)
-        pool.close()
+        schedule(extract_frames_ffmpeg, infos, processes=processes)
 
         return "Success"
     except Exception as e:
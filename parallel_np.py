@@ -4,11 +4,16 @@ import os
 import time
 from multiprocessing import Process
 from typing import List, Tuple, Union
+from queue import LifoQueue
 from subprocess import Popen, PIPE, STDOUT
 
 import cv2
 import numpy as np
 
+from ffmpeg_source import probe_keyframes
+from frame_sampling import sample_frames
+from frame_store import AsyncFrameStoreWriter, FrameStoreWriter, merge_stores
+
 class Preprocess(object):
     
     def __init__(self, input_size, fill_value : int =128):
@@ -28,6 +33,89 @@ class Preprocess(object):
         if isinstance(self.input_size, List) or isinstance(self.input_size, Tuple):
             assert self.input_size[0] == self.input_size[1] , "Input weight and width are not the same."
             self.input_size = int(self.input_size[0])
+
+        # letterbox geometry per input frame shape, a fixed camera only ever computes it once
+        self._plans = {}
+        # reused letterbox canvas per geometry, its padding areas are filled once at creation
+        self._canvases = {}
+
+    @staticmethod
+    def _letterbox_plan(old_h, old_w, width, height):
+        """
+        Compute the geometry of the aspect-aware resize for a frame shape
+        Parameters
+        ----------
+        old_h         : int
+                        height, of the image before resizing
+        old_w         : int
+                        width, of the image before resizing
+        width         : int
+                        width of newly padded image
+        height        : int
+                        height of newly padded image
+        
+        Returns
+        -------
+        new_w         : int
+                        width, of the image after resizing without losing aspect ratio
+        new_h         : int
+                        height, of the image after resizing without losing aspect ratio
+        w_start       : int
+                        column of the canvas where the resized image starts
+        h_start       : int
+                        row of the canvas where the resized image starts
+        """
+        if old_w > old_h:
+            new_w = width
+            new_h = int(width / old_w * old_h)
+        else:
+            new_w = int(height / old_h * old_w)
+            new_h = height
+
+        # parameter for inserting resized image to the middle of canvas
+        h_start = max(0, height - new_h) // 2
+        w_start = max(0, width - new_w) // 2
+
+        return new_w, new_h, w_start, h_start
+
+    def _letterbox(self, image, interpolation=cv2.INTER_LINEAR):
+        """
+        Resize the image straight into the centre of a reused canvas whose padding areas
+        are already filled, so neither the resized image nor the border is allocated per frame.
+        Every input frame shape gets its own canvas, so mixed resolutions never refill them
+        Parameters
+        ----------
+        image         : numpy array
+                        In BGR format
+                        uint8 numpy array of shape (img_h, img_w, 3)
+        interpolation : int
+                        method, to be applied on the image for resizing
+        
+        Returns
+        -------
+        canvas        : numpy array
+                        uint8 numpy array of shape (input_size, input_size, 3),
+                        overwritten by the next call with the same frame shape
+        """
+        old_h, old_w = image.shape[:2]
+        plan = self._plans.get((old_h, old_w))
+        if plan is None:
+            plan = self._letterbox_plan(old_h, old_w, self.input_size, self.input_size)
+            self._plans[(old_h, old_w)] = plan
+        new_w, new_h, w_start, h_start = plan
+
+        canvas = self._canvases.get(plan)
+        if canvas is None:
+            canvas = np.full((self.input_size, self.input_size, 3), self.fill_value, dtype=np.uint8)
+            self._canvases[plan] = canvas
+
+        roi = canvas[h_start:h_start + new_h, w_start:w_start + new_w]
+        if new_w != old_w or new_h != old_h:
+            cv2.resize(image, (new_w, new_h), dst=roi, interpolation=interpolation)
+        else:
+            roi[...] = image
+
+        return canvas
     
     @staticmethod
     def _aspectaware_resize_padding(image, width, height, interpolation=None, means=None):
@@ -64,12 +152,7 @@ class Preprocess(object):
         """
 
         old_h, old_w, _ = image.shape
-        if old_w > old_h:
-            new_w = width
-            new_h = int(width / old_w * old_h)
-        else:
-            new_w = int(height / old_h * old_w)
-            new_h = height
+        new_w, new_h, w_start, h_start = Preprocess._letterbox_plan(old_h, old_w, width, height)
         
         # resize the image by maintaining aspect ratio
         if new_w != old_w or new_h != old_h:
@@ -81,16 +164,39 @@ class Preprocess(object):
         padding_h = height - new_h
         padding_w = width - new_w
 
-        # parameter for inserting resized image to the middle of canvas
-        h_start = max(0, height - new_h) // 2
-        w_start = max(0, width - new_w) // 2
-
         # pad the resized-contrast ratio maintained image to get desired dimensions
         image = cv2.copyMakeBorder(image, h_start, h_start, w_start, w_start, cv2.BORDER_CONSTANT, value=[means, means, means])
 
         return image, new_w, new_h, old_w, old_h, padding_w, padding_h,
 
-    def __call__(self, img):
+    @staticmethod
+    def _normalize(canvas, out=None):
+        """
+        HWC -> CHW, uint8 -> float32 and scaling to [0, 1] fused in a single pass
+        Parameters
+        ----------
+        canvas      : numpy array
+                      uint8 numpy array of shape (H, W, 3)
+        out         : numpy array
+                      float32 numpy array of shape (1, 3, H, W) or (3, H, W) to write into,
+                      newly allocated as (1, 3, H, W) if None
+        
+        Returns
+        -------
+        out         : numpy array
+                      float32 numpy array, same values as astype(np.float32) / 255.0
+        """
+        if out is None:
+            out = np.empty((1, canvas.shape[2]) + canvas.shape[:2], dtype=np.float32)
+        chw = out[0] if out.ndim == 4 else out
+
+        # deinterleave in uint8 (cheap), then every float32 plane is written exactly once, contiguously
+        for channel, plane in enumerate(cv2.split(canvas)):
+            np.divide(plane, np.float32(255.0), out=chw[channel], dtype=np.float32, casting="unsafe")
+
+        return out
+
+    def __call__(self, img, out=None):
         """
         Preprocess an image for YOLOv5 TensorRT model inferencing.
         Parameters
@@ -98,25 +204,83 @@ class Preprocess(object):
         img         : numpy array
                       In BGR format
                       uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional float32 buffer of shape (1, 3, H, W) or (3, H, W),
+                      e.g a slot of a batch tensor, to write the preprocessed image into
         
         Returns
         -------
         img         : numpy array
                       preprocessed image
-                      float32 numpy array of shape (3, H, W)
+                      float32 numpy array of shape (1, 3, H, W), or `out` if given
         metas       : list
                       list containing additional informations about the image
         """
         # resize the image and pad the image by maintaining contrast ratio
-        img_meta = self._aspectaware_resize_padding(image=img, width=self.input_size, 
-                                            height=self.input_size, interpolation=cv2.INTER_LINEAR, means=self.fill_value)
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
 
-        img = np.transpose(img_meta[0], (2, 0, 1)).astype(np.float32)
-        img = np.expand_dims(img, axis=0)
-        img /= 255.0
+        img = self._normalize(canvas, out=out)
 
         return img
 
+    def letterbox(self, img, out=None):
+        """
+        Letterbox an image to CHW without normalizing it, the uint8 canvas is 4x smaller than
+        the float32 tensor and dividing by 255 can be done when it is loaded
+        Parameters
+        ----------
+        img         : numpy array
+                      In BGR format
+                      uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional uint8 buffer of shape (1, 3, H, W) or (3, H, W) to write into
+        
+        Returns
+        -------
+        img         : numpy array
+                      letterboxed image
+                      uint8 numpy array of shape (1, 3, H, W), or `out` if given
+        """
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
+
+        if out is None:
+            out = np.empty((1, 3, self.input_size, self.input_size), dtype=np.uint8)
+        chw = out[0] if out.ndim == 4 else out
+        cv2.split(canvas, list(chw))
+
+        return out
+
+    def batch(self, frames, out=None):
+        """
+        Preprocess a group of images, of any mix of resolutions, into one batch tensor.
+        Every frame is letterboxed and normalized straight into its row of the batch, no
+        staging copy of the whole stack is made.
+        For callers that already hold a group of raw frames. The readers preprocess every frame
+        as soon as it is decoded, into its queue slot, so that preprocessing overlaps decoding and
+        no frame waits for the rest of a batch, grouping them would not make it cheaper.
+        Parameters
+        ----------
+        frames      : list or numpy array
+                      In BGR format
+                      uint8 numpy arrays of shape (img_h, img_w, 3), or a stack of them
+        out         : numpy array
+                      optional float32 buffer of shape (len(frames), 3, H, W),
+                      e.g a view of a preallocated batch tensor, to write the batch into
+        
+        Returns
+        -------
+        img         : numpy array
+                      preprocessed images
+                      float32 numpy array of shape (len(frames), 3, H, W), or `out` if given
+        """
+        if out is None:
+            out = np.empty((len(frames), 3, self.input_size, self.input_size), dtype=np.float32)
+
+        for i, frame in enumerate(frames):
+            self(frame, out=out[i])
+
+        return out
+
 def extract_frames_ffmpeg(video_path, folder_path):
     print("Extracting frames from {}".format(video_path))
 
@@ -134,7 +298,15 @@ def extract_frames_ffmpeg(video_path, folder_path):
 
     print("Extracting frames from {:s} done!".format(abs_video_path))
 
-def extract_preprocessed_frames_opencv(video_path, folder_name):
+def extract_preprocessed_frames_opencv(video_path, folder_name, storage : str ="float32", num_writers : int =1,
+                                       max_pending : int =4, fsync : str ="close", stride : int =1, fps=None,
+                                       keyframes_only : bool =False):
+    # storage "float32" saves model ready tensors, "uint8" saves the 4x smaller letterboxed
+    # canvases and leaves dividing by 255 to FrameStore.load
+    # num_writers background threads write the frames, decoding only waits for them once
+    # max_pending frames are queued, fsync is "always", "close" or "never"
+    # stride, fps or keyframes_only select the frames that are kept, see sample_frames,
+    # frames are saved with their index in the source video
     print("Extracting frames from {}".format(video_path))
 
     abs_video_path = os.path.abspath(video_path)
@@ -142,23 +314,107 @@ def extract_preprocessed_frames_opencv(video_path, folder_name):
     folder_path = "data/{:s}".format(folder_name)
     preprocess_fn = Preprocess(input_size = 640)
 
-    count = 0
+    keyframes = probe_keyframes(abs_video_path)[0] if keyframes_only else None
     vidcap = cv2.VideoCapture(abs_video_path)
+    # every frame goes into one append-only store instead of one npy file per frame
+    store = AsyncFrameStoreWriter("%s/frames" % folder_path, frame_shape=(3, 640, 640), dtype=storage, fields=("frame",),
+                                  num_workers=num_writers, max_pending=max_pending, fsync=fsync)
+    # frame buffers are recycled once the writer is done with them, one more than the writer can hold
+    buffers = LifoQueue()
+    for _ in range(max_pending + num_writers + 1):
+        buffers.put(np.empty((1, 3, 640, 640), dtype=storage))
+    preprocess = preprocess_fn.letterbox if storage == "uint8" else preprocess_fn
 
-    while True:
-        success, image = vidcap.read()
+    for index, image in sample_frames(vidcap, stride=stride, fps=fps, keyframes=keyframes):
+        store.append(preprocess(image, out=buffers.get()), keys=[index], on_done=buffers.put)
+
+    vidcap.release()
+    store.close()
+    print("Writer saved {saved_time:.3f}s of the decode loop ({write_time:.3f}s writing, {wait_time:.3f}s waiting)".format(**store.report()))
+    print("Extracting and Preprocessing frames from {:s} done!".format(abs_video_path))
+
+def plan_segments(keyframes, num_frames, num_segments):
+    # Split frames [0, num_frames) into at most num_segments ranges of about equal length,
+    # every range but the first starts on a keyframe so that it can be decoded on its own
+    starts = [0]
+    for i in range(1, num_segments):
+        target = i * num_frames / num_segments
+        keyframe = min(keyframes, key=lambda frame: abs(frame - target), default=0)
+        if keyframe > starts[-1]:
+            starts.append(keyframe)
+
+    return list(zip(starts, starts[1:] + [num_frames]))
 
+def extract_segment_opencv(video_path, store_path, start, stop, frame_times, tolerance, storage : str ="float32"):
+    # Decode and preprocess frames [start, stop) of a video, saved with their global frame index.
+    # frame_times are the probed times of these frames, every decoded frame must be within tolerance
+    # seconds of its own, a seek or a decode that lands elsewhere raises instead of mislabelling frames
+    preprocess_fn = Preprocess(input_size = 640)
+    preprocess = preprocess_fn.letterbox if storage == "uint8" else preprocess_fn
+
+    vidcap = cv2.VideoCapture(video_path)
+    if start:
+        # opencv estimates this seek from timestamps, it can be off on VFR or B-frame videos, checked below
+        vidcap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    store = FrameStoreWriter(store_path, frame_shape=(3, 640, 640), dtype=storage, fields=("frame",))
+    npy = np.empty((1, 3, 640, 640), dtype=storage)
+    for index, expected in zip(range(start, stop), frame_times):
+        success, image = vidcap.read()
         if not success:
-            print(success)
             break
-        else:
-            npy_path = "%s/out-%04d.npy" % (folder_path, count)
-            npy = preprocess_fn(image)
-            np.save(npy_path, npy)
-            success,image = vidcap.read()
-            count += 1
+        position = vidcap.get(cv2.CAP_PROP_POS_MSEC) / 1000  # time of the frame just read
+        if abs(position - expected) > tolerance:
+            store.close()
+            vidcap.release()
+            raise RuntimeError("Frame {} of {} was decoded at {:.3f}s instead of {:.3f}s, the seek to frame {} missed.".format(
+                index, video_path, position, expected, start))
+        store.append(preprocess(image, out=npy), keys=[index])
 
-    print("Extracting and Preprocessing frames from {:s} done!".format(abs_video_path))
+    store.close()
+    vidcap.release()
+
+def extract_preprocessed_segments_opencv(video_path, folder_name, num_segments : int =4, storage : str ="float32"):
+    # Decode a single video on num_segments cores, split at keyframes, each segment in its own process
+    print("Extracting frames from {} in {} segments".format(video_path, num_segments))
+
+    abs_video_path = os.path.abspath(video_path)
+    folder_path = "data/{:s}".format(folder_name)
+
+    keyframes, num_frames, frame_times = probe_keyframes(abs_video_path, times=True)
+    segments = plan_segments(keyframes, num_frames, num_segments)
+    part_paths = ["%s/frames-part%02d" % (folder_path, i) for i in range(len(segments))]
+    # a decoded frame belongs to a probed one if it is closer to it than to its neighbours
+    gaps = np.diff(frame_times)
+    tolerance = gaps[gaps > 0].min() / 2 if np.any(gaps > 0) else 0.001
+
+    processes = [Process(target=extract_segment_opencv,
+                         args=(abs_video_path, part_path, start, stop, frame_times[start:stop], tolerance, storage,))
+                 for part_path, (start, stop) in zip(part_paths, segments)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [segment for segment, process in zip(segments, processes) if process.exitcode != 0]
+    if failed:
+        # a rerun must not find the parts of the segments that did decode next to its own
+        for part_path in part_paths:
+            for extension in (".json", ".bin", ".idx"):
+                if os.path.exists(part_path + extension):
+                    os.remove(part_path + extension)
+        raise RuntimeError("Segments {} of {} failed to decode.".format(failed, abs_video_path))
+
+    # segments are in frame order, so their stores are stitched by concatenating them
+    store = merge_stores(part_paths, "%s/frames" % folder_path)
+    frames = store.field("frame")
+    if not np.array_equal(frames, np.arange(len(frames))):
+        # a segment that could not decode all of its frames leaves a gap before the next one
+        raise RuntimeError("Segments of {} left gaps in between.".format(abs_video_path))
+    missing = num_frames - len(frames)
+    if missing:
+        print("{} frames at the end of {} could not be decoded".format(missing, abs_video_path))
+
+    print("Extracting and Preprocessing frames from {:s} in segments {} done!".format(abs_video_path, segments))
 
 if __name__ == "__main__":
 
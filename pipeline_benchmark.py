@@ -0,0 +1,321 @@
+"""
+Run every frame extraction strategy of the repo on the same videos and compare them
+
+1. sync_video                 : ffmpeg to JPEG, one video after another
+2. multiprocess_video         : ffmpeg to JPEG, a pool of processes, longest video first
+3. asyncio_video              : ffmpeg to JPEG, asyncio subprocesses
+4. asyncio_video_v2           : OpenCV to JPEG, async frame iterators on a shared thread pool
+5. sequential_np              : OpenCV + Preprocess to a frame store, one video after another
+6. parallel_np                : OpenCV + Preprocess to a frame store, one process per video
+7. parallel_np_segments       : OpenCV + Preprocess, every video split into keyframe-aligned segments
+8. reader_writer_queue_np     : reader process -> Queue -> preprocessor process writing npy files
+9. reader_writer_queue_np_v2  : one process per video -> shared memory rings -> dynamic batches
+10. reader_writer_queue_thread : one thread per video -> Queue -> dynamic batches
+
+Every strategy runs in a new process, in a scratch folder holding its data/ outputs, and reports
+1. fps             : frames written per second of wall time
+2. inter_output_ms : time between two consecutive output frames of a video, p50 / p90 / p99 / max,
+                     from the modification times of per-frame files or the growth of frame stores.
+                     How steadily frames come out, not how long a frame takes: batched strategies
+                     write a whole batch at once, every frame but the first of a batch counts about 0 ms
+3. latency_ms      : decode to write time of every frame, p50 / p90 / p99 / max, from frame_trace,
+                     only for the strategies that trace their frames (reader_writer_queue_np_v2), else None
+4. first_frame_s   : time until the first frame of any video was written
+5. cpu             : CPU seconds of the strategy and all of its child processes (ffmpeg included),
+                     and cpu_utilization, the number of cores they kept busy on average
+6. peak_rss_mb     : peak resident memory of the largest of its processes
+
+A strategy function may return a frame_trace.FrameTracer of its frames, for latency_ms.
+
+    python pipeline_benchmark.py --output results.json videos/1.mp4 videos/2.mp4
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import multiprocessing
+
+import numpy as np
+
+def run_sync_video(videos):
+    import sync_video
+    for i, video in enumerate(videos):
+        sync_video.extract_frames_ffmpeg(video_path=video, folder_name=str(i + 1))
+
+def run_multiprocess_video(videos):
+    import multiprocess_video
+    multiprocess_video.extract(infos=[[video, str(i + 1)] for i, video in enumerate(videos)], processes=4)
+
+def run_asyncio_video(videos):
+    import asyncio_video
+    asyncio.run(asyncio_video.extract([[video, str(i + 1)] for i, video in enumerate(videos)], max_processes=4))
+
+def run_asyncio_video_v2(videos):
+    import asyncio_video_v2
+    from concurrent.futures import ThreadPoolExecutor
+
+    async def extract():
+        executor = ThreadPoolExecutor(max_workers=8)
+        await asyncio.gather(*[asyncio_video_v2.extract_frames_opencv(video, str(i + 1), executor=executor)
+                               for i, video in enumerate(videos)])
+        executor.shutdown()
+
+    asyncio.run(extract())
+
+def run_sequential_np(videos):
+    import sequential_np
+    for i, video in enumerate(videos):
+        sequential_np.extract_preprocessed_frames_opencv(video_path=video, folder_name=str(i + 1))
+
+def run_parallel_np(videos):
+    import parallel_np
+    processes = [multiprocessing.Process(target=parallel_np.extract_preprocessed_frames_opencv, args=(video, str(i + 1),))
+                 for i, video in enumerate(videos)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def run_parallel_np_segments(videos):
+    import parallel_np
+    for i, video in enumerate(videos):
+        parallel_np.extract_preprocessed_segments_opencv(video, str(i + 1), num_segments=os.cpu_count() or 4)
+
+def run_reader_writer_queue_np(videos):
+    import reader_writer_queue_np
+    # the preprocessor always writes data/queue/out-%04d.npy, the outputs of a video are moved to data/<i>
+    for i, video in enumerate(videos):
+        queue = multiprocessing.Queue()
+        reader_p = multiprocessing.Process(target=reader_writer_queue_np.preprocessor_proc, args=(queue,))
+        reader_p.daemon = True
+        reader_p.start()
+        reader_writer_queue_np.frames_grasp_proc(video, queue)
+        reader_p.join()
+        os.rmdir("data/{}".format(i + 1))
+        os.rename("data/queue", "data/{}".format(i + 1))
+        os.makedirs("data/queue")
+
+def run_reader_writer_queue_np_v2(videos):
+    import reader_writer_queue_np_v2 as rw
+    from frame_trace import FrameTracer
+    tracer = FrameTracer([str(i + 1) for i in range(len(videos))])
+    queues = [multiprocessing.Queue() for _ in videos]
+    rings = [rw.SharedFrameRing(num_slots=8, frame_shape=(1, 3, 640, 640), dtype=np.float32) for _ in videos]
+    streams = [multiprocessing.Process(target=rw.preprocessor_proc, args=(video, queue, ring,), daemon=True)
+               for video, queue, ring in zip(videos, queues, rings)]
+    for stream_p in streams:
+        stream_p.start()
+
+    rw.batch_multiplex_proc(queues, rings, max_batch_size=8, max_wait=0.05, tracer=tracer)
+
+    for stream_p in streams:
+        stream_p.join()
+    for ring in rings:
+        ring.close()
+        ring.unlink()
+    return tracer
+
+def run_reader_writer_queue_thread(videos):
+    import reader_writer_queue_thread as rw
+    from queue import Queue
+    queues = [Queue() for _ in videos]
+    readers = [rw.VideoReader(video=video, queue=queue) for video, queue in zip(videos, queues)]
+    for reader in readers:
+        reader.start()
+
+    rw.batch_multiplex(queues=queues, max_batch_size=8, max_wait=0.05)
+
+    for reader in readers:
+        reader.join()
+
+STRATEGIES = {
+    "sync_video": run_sync_video,
+    "multiprocess_video": run_multiprocess_video,
+    "asyncio_video": run_asyncio_video,
+    "asyncio_video_v2": run_asyncio_video_v2,
+    "sequential_np": run_sequential_np,
+    "parallel_np": run_parallel_np,
+    "parallel_np_segments": run_parallel_np_segments,
+    "reader_writer_queue_np": run_reader_writer_queue_np,
+    "reader_writer_queue_np_v2": run_reader_writer_queue_np_v2,
+    "reader_writer_queue_thread": run_reader_writer_queue_thread,
+}
+
+class StoreWatcher(threading.Thread):
+    # Sample the size of every data/*/frames*.bin, frame stores have no per-frame timestamps
+    def __init__(self, interval : float =0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = {}       # store path -> [(time, size)]
+        self.frame_nbytes = {}  # store path -> size of a frame, the header of a merged part is gone afterwards
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            now = time.time()
+            for path in glob.glob("data/*/frames*.bin"):
+                try:
+                    size = os.path.getsize(path)
+                    if path not in self.frame_nbytes:
+                        with open(path[:-len(".bin")] + ".json") as header_file:
+                            header = json.load(header_file)
+                        self.frame_nbytes[path] = int(np.prod(header["frame_shape"])) * np.dtype(header["dtype"]).itemsize
+                except (OSError, ValueError):
+                    continue
+                samples = self.samples.setdefault(path, [])
+                if not samples or samples[-1][1] != size:
+                    samples.append((now, size))
+            self._stopping.wait(self.interval)
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+def output_times(watcher):
+    # Time every output frame was written, per output (folder of per-frame files or frame store)
+    times = {}
+    for folder in sorted(glob.glob("data/*")):
+        files = [entry for entry in os.scandir(folder) if entry.name.endswith((".jpg", ".npy"))]
+        if files:
+            times[folder] = np.sort([entry.stat().st_mtime_ns / 1e9 for entry in files])
+
+    # frames of a store written in parts are timed by the parts, not by their merged copy
+    parted = {os.path.dirname(path) for path in watcher.samples if not path.endswith("frames.bin")}
+    for path, samples in watcher.samples.items():
+        if path.endswith("frames.bin") and os.path.dirname(path) in parted:
+            continue
+        sample_times = np.array([t for t, _ in samples])
+        frames = np.maximum.accumulate(np.array([size for _, size in samples]) // watcher.frame_nbytes[path])
+        # frame k was complete at the first sample that holds k + 1 frames
+        positions = np.searchsorted(frames, np.arange(1, frames[-1] + 1), side="left")
+        times[path] = sample_times[positions]
+
+    return times
+
+def worker(name, videos, result_path):
+    # Runs in a new process, inside the scratch folder of the strategy
+    for folder in [str(i + 1) for i in range(len(videos))] + ["queue"]:
+        os.makedirs(os.path.join("data", folder), exist_ok=True)
+    # everything the strategy, its child processes and ffmpeg print goes to strategy.log
+    log = open("strategy.log", "w")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    result = {"strategy": name}
+    tracer = None
+    watcher = StoreWatcher()
+    _self, _children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    _start = time.time()
+    watcher.start()
+    try:
+        tracer = STRATEGIES[name](videos)
+    except BaseException as e:
+        result["error"] = repr(e)
+    elapsed = time.time() - _start
+    watcher.stop()
+    usage_self, usage_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = sum(usage.ru_utime + usage.ru_stime for usage in (usage_self, usage_children)) - \
+          sum(usage.ru_utime + usage.ru_stime for usage in (_self, _children))
+    times = output_times(watcher)
+    frames = sum(len(t) for t in times.values())
+    intervals = np.concatenate([np.diff(t) for t in times.values()] + [np.zeros(0)]) * 1000
+    latency = tracer.report()["stages"]["total"]["all"] if tracer is not None else None
+
+    result.update({
+        "wall_s": elapsed,
+        "frames": int(frames),
+        "fps": frames / elapsed,
+        "first_frame_s": float(min(t[0] for t in times.values()) - _start) if frames else None,
+        "inter_output_ms": {key: float(np.percentile(intervals, q)) for key, q in (("p50", 50), ("p90", 90), ("p99", 99))}
+                           if intervals.size else None,
+        "latency_ms": {key: 1000 * latency[key] for key in ("p50", "p90", "p99", "max")}
+                      if latency is not None and latency["count"] else None,
+        "cpu_s": cpu,
+        "cpu_utilization": cpu / elapsed,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": max(usage_self.ru_maxrss, usage_children.ru_maxrss) / 1024,
+    })
+    if intervals.size:
+        result["inter_output_ms"]["max"] = float(intervals.max())
+
+    log.close()
+    with open(result_path, "w") as result_file:
+        json.dump(result, result_file)
+
+def run_strategy(name, videos, keep : bool =False):
+    # Run a strategy in a new process and scratch folder, the strategies write to relative data/ paths
+    folder = tempfile.mkdtemp(prefix="benchmark-{}-".format(name))
+    result_path = os.path.join(folder, "result.json")
+    repo = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+
+    context = multiprocessing.get_context("spawn")
+    os.chdir(folder)
+    sys.path.insert(0, repo)
+    try:
+        process = context.Process(target=worker, args=(name, videos, result_path))
+        process.start()
+        process.join()
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(repo)
+
+    if os.path.exists(result_path):
+        with open(result_path) as result_file:
+            result = json.load(result_file)
+    else:
+        result = {"strategy": name, "error": "worker exited with code {}".format(process.exitcode)}
+
+    if keep:
+        result["folder"] = folder
+    else:
+        shutil.rmtree(folder, ignore_errors=True)
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the frame extraction strategies on the same videos")
+    parser.add_argument("videos", nargs="*", help="video corpus, videos/*.mp4 if not given")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="comma separated strategies to run")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file of the results")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch folders with the outputs and logs")
+    args = parser.parse_args()
+
+    strategies = args.strategies.split(",")
+    unknown = [name for name in strategies if name not in STRATEGIES]
+    if unknown:
+        parser.error("unknown strategies {}, choose from {}".format(unknown, list(STRATEGIES)))
+    videos = [os.path.abspath(video) for video in (args.videos or sorted(glob.glob("videos/*.mp4")))]
+    assert videos, "No videos to run the strategies on."
+
+    results = {"videos": videos, "python": platform.python_version(), "platform": platform.platform(),
+               "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "strategies": []}
+    for name in strategies:
+        result = run_strategy(name, videos, keep=args.keep)
+        results["strategies"].append(result)
+        if "error" in result and "fps" not in result:
+            print("{:28s} : failed, {}".format(name, result["error"]))
+        else:
+            print("{:28s} : {:5d} frames, {:7.1f} frames/s, inter-output p50 {} ms p99 {} ms, latency p50 {} ms p99 {} ms, "
+                  "{:.2f} cores, {:.0f} MB{}".format(
+                name, result["frames"], result["fps"],
+                "{:.1f}".format(result["inter_output_ms"]["p50"]) if result["inter_output_ms"] else "-",
+                "{:.1f}".format(result["inter_output_ms"]["p99"]) if result["inter_output_ms"] else "-",
+                "{:.1f}".format(result["latency_ms"]["p50"]) if result["latency_ms"] else "-",
+                "{:.1f}".format(result["latency_ms"]["p99"]) if result["latency_ms"] else "-",
+                result["cpu_utilization"], result["peak_rss_mb"], ", " + result["error"] if "error" in result else ""))
+
+        # written after every strategy, a crash later on keeps the results so far
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
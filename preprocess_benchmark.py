@@ -0,0 +1,66 @@
+"""
+Per-frame cost of the preprocessing paths of Preprocess
+
+1. legacy       : letterbox -> transpose -> astype(float32) -> expand_dims -> /= 255
+                  the result is a transposed view of HWC memory, the CHW reorder is only paid
+                  later when the frame is copied into a batch / shared memory slot or saved
+2. legacy, slot : legacy + the copy into a batch tensor slot that the pipelines do with it
+3. fused        : cached letterbox plan, resize into a reused canvas -> HWC->CHW, uint8->float32
+                  and /255 writing every float once
+4. fused, out   : same as fused, but written into a preallocated batch tensor slot
+5. batch        : Preprocess.batch over all frames at once into the preallocated batch tensor
+The slot paths write every frame into its own row of the batch tensor, as the pipelines do,
+so that they touch as much memory as batch does.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from reader_writer_queue_np_v2 import Preprocess
+
+def legacy_preprocess(preprocessor, img):
+    # Preprocess.__call__ before the fused kernel, kept here as the reference
+    img_meta = preprocessor._aspectaware_resize_padding(image=img, width=preprocessor.input_size,
+                                                        height=preprocessor.input_size, interpolation=cv2.INTER_LINEAR,
+                                                        means=preprocessor.fill_value)
+
+    img = np.transpose(img_meta[0], (2, 0, 1)).astype(np.float32)
+    img = np.expand_dims(img, axis=0)
+    img /= 255.0
+
+    return img
+
+def time_per_frame(fn, frames, repeats):
+    _start = time.perf_counter()
+    for _ in range(repeats):
+        for frame in frames:
+            fn(frame)
+    return (time.perf_counter() - _start) / (repeats * len(frames))
+
+if __name__ == '__main__':
+    preprocessor = Preprocess(input_size=640)
+    batch = np.empty((8, 3, 640, 640), dtype=np.float32)
+
+    for width, height in [(640, 480), (1280, 720), (1920, 1080)]:
+        frames = [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(8)]
+
+        # fused path must be bit-identical to the legacy one
+        for i, frame in enumerate(frames):
+            reference = legacy_preprocess(preprocessor, frame)
+            assert np.array_equal(reference, preprocessor(frame)), "fused path differs from the legacy path"
+            assert np.array_equal(reference[0], preprocessor(frame, out=batch[i])), "out= path differs from the legacy path"
+        assert np.array_equal(batch, preprocessor.batch(frames)), "batch path differs from the legacy path"
+
+        def legacy_into_slot(i):
+            batch[i] = legacy_preprocess(preprocessor, frames[i])
+
+        legacy_t = time_per_frame(lambda frame: legacy_preprocess(preprocessor, frame), frames, repeats=10)
+        slot_t = time_per_frame(legacy_into_slot, range(len(frames)), repeats=10)
+        fused_t = time_per_frame(lambda frame: preprocessor(frame), frames, repeats=10)
+        out_t = time_per_frame(lambda i: preprocessor(frames[i], out=batch[i]), range(len(frames)), repeats=10)
+        batch_t = time_per_frame(lambda frames: preprocessor.batch(frames, out=batch), [frames], repeats=10) / len(frames)
+
+        print("{}x{} legacy : {:.3f} ms, legacy + slot copy : {:.3f} ms, fused : {:.3f} ms, fused out= : {:.3f} ms ({:.2f}x), batch : {:.3f} ms ({:.2f}x)".format(
+            width, height, legacy_t * 1e3, slot_t * 1e3, fused_t * 1e3, out_t * 1e3, slot_t / out_t, batch_t * 1e3, slot_t / batch_t))
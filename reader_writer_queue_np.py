@@ -16,6 +16,8 @@ from multiprocessing import Process, Queue
 import cv2
 import numpy as np
 
+from queue_metrics import QueueMetrics
+
 class Preprocess(object):
     
     def __init__(self, input_size, fill_value : int =128):
@@ -35,6 +37,89 @@ class Preprocess(object):
         if isinstance(self.input_size, List) or isinstance(self.input_size, Tuple):
             assert self.input_size[0] == self.input_size[1] , "Input weight and width are not the same."
             self.input_size = int(self.input_size[0])
+
+        # letterbox geometry per input frame shape, a fixed camera only ever computes it once
+        self._plans = {}
+        # reused letterbox canvas per geometry, its padding areas are filled once at creation
+        self._canvases = {}
+
+    @staticmethod
+    def _letterbox_plan(old_h, old_w, width, height):
+        """
+        Compute the geometry of the aspect-aware resize for a frame shape
+        Parameters
+        ----------
+        old_h         : int
+                        height, of the image before resizing
+        old_w         : int
+                        width, of the image before resizing
+        width         : int
+                        width of newly padded image
+        height        : int
+                        height of newly padded image
+        
+        Returns
+        -------
+        new_w         : int
+                        width, of the image after resizing without losing aspect ratio
+        new_h         : int
+                        height, of the image after resizing without losing aspect ratio
+        w_start       : int
+                        column of the canvas where the resized image starts
+        h_start       : int
+                        row of the canvas where the resized image starts
+        """
+        if old_w > old_h:
+            new_w = width
+            new_h = int(width / old_w * old_h)
+        else:
+            new_w = int(height / old_h * old_w)
+            new_h = height
+
+        # parameter for inserting resized image to the middle of canvas
+        h_start = max(0, height - new_h) // 2
+        w_start = max(0, width - new_w) // 2
+
+        return new_w, new_h, w_start, h_start
+
+    def _letterbox(self, image, interpolation=cv2.INTER_LINEAR):
+        """
+        Resize the image straight into the centre of a reused canvas whose padding areas
+        are already filled, so neither the resized image nor the border is allocated per frame.
+        Every input frame shape gets its own canvas, so mixed resolutions never refill them
+        Parameters
+        ----------
+        image         : numpy array
+                        In BGR format
+                        uint8 numpy array of shape (img_h, img_w, 3)
+        interpolation : int
+                        method, to be applied on the image for resizing
+        
+        Returns
+        -------
+        canvas        : numpy array
+                        uint8 numpy array of shape (input_size, input_size, 3),
+                        overwritten by the next call with the same frame shape
+        """
+        old_h, old_w = image.shape[:2]
+        plan = self._plans.get((old_h, old_w))
+        if plan is None:
+            plan = self._letterbox_plan(old_h, old_w, self.input_size, self.input_size)
+            self._plans[(old_h, old_w)] = plan
+        new_w, new_h, w_start, h_start = plan
+
+        canvas = self._canvases.get(plan)
+        if canvas is None:
+            canvas = np.full((self.input_size, self.input_size, 3), self.fill_value, dtype=np.uint8)
+            self._canvases[plan] = canvas
+
+        roi = canvas[h_start:h_start + new_h, w_start:w_start + new_w]
+        if new_w != old_w or new_h != old_h:
+            cv2.resize(image, (new_w, new_h), dst=roi, interpolation=interpolation)
+        else:
+            roi[...] = image
+
+        return canvas
     
     @staticmethod
     def _aspectaware_resize_padding(image, width, height, interpolation=None, means=None):
@@ -71,12 +156,7 @@ class Preprocess(object):
         """
 
         old_h, old_w, _ = image.shape
-        if old_w > old_h:
-            new_w = width
-            new_h = int(width / old_w * old_h)
-        else:
-            new_w = int(height / old_h * old_w)
-            new_h = height
+        new_w, new_h, w_start, h_start = Preprocess._letterbox_plan(old_h, old_w, width, height)
         
         # resize the image by maintaining aspect ratio
         if new_w != old_w or new_h != old_h:
@@ -88,16 +168,39 @@ class Preprocess(object):
         padding_h = height - new_h
         padding_w = width - new_w
 
-        # parameter for inserting resized image to the middle of canvas
-        h_start = max(0, height - new_h) // 2
-        w_start = max(0, width - new_w) // 2
-
         # pad the resized-contrast ratio maintained image to get desired dimensions
         image = cv2.copyMakeBorder(image, h_start, h_start, w_start, w_start, cv2.BORDER_CONSTANT, value=[means, means, means])
 
         return image, new_w, new_h, old_w, old_h, padding_w, padding_h,
 
-    def __call__(self, img):
+    @staticmethod
+    def _normalize(canvas, out=None):
+        """
+        HWC -> CHW, uint8 -> float32 and scaling to [0, 1] fused in a single pass
+        Parameters
+        ----------
+        canvas      : numpy array
+                      uint8 numpy array of shape (H, W, 3)
+        out         : numpy array
+                      float32 numpy array of shape (1, 3, H, W) or (3, H, W) to write into,
+                      newly allocated as (1, 3, H, W) if None
+        
+        Returns
+        -------
+        out         : numpy array
+                      float32 numpy array, same values as astype(np.float32) / 255.0
+        """
+        if out is None:
+            out = np.empty((1, canvas.shape[2]) + canvas.shape[:2], dtype=np.float32)
+        chw = out[0] if out.ndim == 4 else out
+
+        # deinterleave in uint8 (cheap), then every float32 plane is written exactly once, contiguously
+        for channel, plane in enumerate(cv2.split(canvas)):
+            np.divide(plane, np.float32(255.0), out=chw[channel], dtype=np.float32, casting="unsafe")
+
+        return out
+
+    def __call__(self, img, out=None):
         """
         Preprocess an image for YOLOv5 TensorRT model inferencing.
         Parameters
@@ -105,27 +208,86 @@ class Preprocess(object):
         img         : numpy array
                       In BGR format
                       uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional float32 buffer of shape (1, 3, H, W) or (3, H, W),
+                      e.g a slot of a batch tensor, to write the preprocessed image into
         
         Returns
         -------
         img         : numpy array
                       preprocessed image
-                      float32 numpy array of shape (3, H, W)
+                      float32 numpy array of shape (1, 3, H, W), or `out` if given
         metas       : list
                       list containing additional informations about the image
         """
         # resize the image and pad the image by maintaining contrast ratio
-        img_meta = self._aspectaware_resize_padding(image=img, width=self.input_size, 
-                                            height=self.input_size, interpolation=cv2.INTER_LINEAR, means=self.fill_value)
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
 
-        img = np.transpose(img_meta[0], (2, 0, 1)).astype(np.float32)
-        img = np.expand_dims(img, axis=0)
-        img /= 255.0
+        img = self._normalize(canvas, out=out)
 
         return img
 
-def preprocessor_proc(queue):
+    def letterbox(self, img, out=None):
+        """
+        Letterbox an image to CHW without normalizing it, the uint8 canvas is 4x smaller than
+        the float32 tensor and dividing by 255 can be done when it is loaded
+        Parameters
+        ----------
+        img         : numpy array
+                      In BGR format
+                      uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional uint8 buffer of shape (1, 3, H, W) or (3, H, W) to write into
+        
+        Returns
+        -------
+        img         : numpy array
+                      letterboxed image
+                      uint8 numpy array of shape (1, 3, H, W), or `out` if given
+        """
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
+
+        if out is None:
+            out = np.empty((1, 3, self.input_size, self.input_size), dtype=np.uint8)
+        chw = out[0] if out.ndim == 4 else out
+        cv2.split(canvas, list(chw))
+
+        return out
+
+    def batch(self, frames, out=None):
+        """
+        Preprocess a group of images, of any mix of resolutions, into one batch tensor.
+        Every frame is letterboxed and normalized straight into its row of the batch, no
+        staging copy of the whole stack is made.
+        For callers that already hold a group of raw frames. The readers preprocess every frame
+        as soon as it is decoded, into its queue slot, so that preprocessing overlaps decoding and
+        no frame waits for the rest of a batch, grouping them would not make it cheaper.
+        Parameters
+        ----------
+        frames      : list or numpy array
+                      In BGR format
+                      uint8 numpy arrays of shape (img_h, img_w, 3), or a stack of them
+        out         : numpy array
+                      optional float32 buffer of shape (len(frames), 3, H, W),
+                      e.g a view of a preallocated batch tensor, to write the batch into
+        
+        Returns
+        -------
+        img         : numpy array
+                      preprocessed images
+                      float32 numpy array of shape (len(frames), 3, H, W), or `out` if given
+        """
+        if out is None:
+            out = np.empty((len(frames), 3, self.input_size, self.input_size), dtype=np.float32)
+
+        for i, frame in enumerate(frames):
+            self(frame, out=out[i])
+
+        return out
+
+def preprocessor_proc(queue, metrics=None):
     ## Read from the queue; this will be spawned as a seperate process
+    ## frames taken from the queue are counted as consumed in the QueueMetrics if any, nothing is printed per frame
 
     # create an instance of the preprocess class
     preprocessor = Preprocess(input_size=640) 
@@ -139,10 +301,11 @@ def preprocessor_proc(queue):
             npy = preprocessor(frame)
             npy_path = "%s/%s/out-%04d.npy" % ("data", "queue", count)
             np.save(npy_path, npy)
-            print("Reader Queue Length : {}".format(queue.qsize()))
+            if metrics is not None:
+                metrics.consumed(0)
             count += 1
 
-def frames_grasp_proc(video ,queue):
+def frames_grasp_proc(video ,queue, metrics=None):
 
     # Write the frames, read with opencv, to the queue
     video_path = os.path.abspath(video)
@@ -156,15 +319,20 @@ def frames_grasp_proc(video ,queue):
             queue.put("None")
             break
         else:
+            # counted before the put, the consumer can take the frame as soon as it is on the queue
+            if metrics is not None:
+                metrics.produced(0)
             queue.put(image)
-            print("Writer Queue Length : {}".format(queue.qsize()))
 
 if __name__=='__main__':
     pqueue = Queue()  # frames_grasp_proc() writes to pqueue from _this_ process
-    reader_p = Process(target=preprocessor_proc, args=((pqueue),))
+    metrics = QueueMetrics(["1"], interval=1.0)  # depth and rates of pqueue, sampled and printed once a second
+    reader_p = Process(target=preprocessor_proc, args=(pqueue, metrics,))
     reader_p.daemon = True
     reader_p.start()  # Launch preprocessor_proc() as a separate python process
 
-    frames_grasp_proc("videos/1.mp4", pqueue) # send video path and queue as args to proc
+    metrics.start()
+    frames_grasp_proc("videos/1.mp4", pqueue, metrics) # send video path, queue and counters as args to proc
 
-    reader_p.join()
\ No newline at end of file
+    reader_p.join()
+    metrics.stop()
\ No newline at end of file
@@ -5,6 +5,7 @@ https://stackoverflow.com/questions/11515944/how-to-use-multiprocessing-queue-in
 2. Python multiprocessing
 3. Pytorch multiprocessing
 4. Bounded Buffer problem
+5. Per-stage latency of every frame, see frame_trace
 """
 
 import os
@@ -16,6 +17,9 @@ from multiprocessing import Process, Queue
 import cv2
 import numpy as np
 
+from frame_trace import FrameTracer
+from queue_metrics import QueueMetrics
+
 class Preprocess(object):
     
     def __init__(self, input_size, fill_value : int =128):
@@ -35,6 +39,89 @@ class Preprocess(object):
         if isinstance(self.input_size, List) or isinstance(self.input_size, Tuple):
             assert self.input_size[0] == self.input_size[1] , "Input weight and width are not the same."
             self.input_size = int(self.input_size[0])
+
+        # letterbox geometry per input frame shape, a fixed camera only ever computes it once
+        self._plans = {}
+        # reused letterbox canvas per geometry, its padding areas are filled once at creation
+        self._canvases = {}
+
+    @staticmethod
+    def _letterbox_plan(old_h, old_w, width, height):
+        """
+        Compute the geometry of the aspect-aware resize for a frame shape
+        Parameters
+        ----------
+        old_h         : int
+                        height, of the image before resizing
+        old_w         : int
+                        width, of the image before resizing
+        width         : int
+                        width of newly padded image
+        height        : int
+                        height of newly padded image
+        
+        Returns
+        -------
+        new_w         : int
+                        width, of the image after resizing without losing aspect ratio
+        new_h         : int
+                        height, of the image after resizing without losing aspect ratio
+        w_start       : int
+                        column of the canvas where the resized image starts
+        h_start       : int
+                        row of the canvas where the resized image starts
+        """
+        if old_w > old_h:
+            new_w = width
+            new_h = int(width / old_w * old_h)
+        else:
+            new_w = int(height / old_h * old_w)
+            new_h = height
+
+        # parameter for inserting resized image to the middle of canvas
+        h_start = max(0, height - new_h) // 2
+        w_start = max(0, width - new_w) // 2
+
+        return new_w, new_h, w_start, h_start
+
+    def _letterbox(self, image, interpolation=cv2.INTER_LINEAR):
+        """
+        Resize the image straight into the centre of a reused canvas whose padding areas
+        are already filled, so neither the resized image nor the border is allocated per frame.
+        Every input frame shape gets its own canvas, so mixed resolutions never refill them
+        Parameters
+        ----------
+        image         : numpy array
+                        In BGR format
+                        uint8 numpy array of shape (img_h, img_w, 3)
+        interpolation : int
+                        method, to be applied on the image for resizing
+        
+        Returns
+        -------
+        canvas        : numpy array
+                        uint8 numpy array of shape (input_size, input_size, 3),
+                        overwritten by the next call with the same frame shape
+        """
+        old_h, old_w = image.shape[:2]
+        plan = self._plans.get((old_h, old_w))
+        if plan is None:
+            plan = self._letterbox_plan(old_h, old_w, self.input_size, self.input_size)
+            self._plans[(old_h, old_w)] = plan
+        new_w, new_h, w_start, h_start = plan
+
+        canvas = self._canvases.get(plan)
+        if canvas is None:
+            canvas = np.full((self.input_size, self.input_size, 3), self.fill_value, dtype=np.uint8)
+            self._canvases[plan] = canvas
+
+        roi = canvas[h_start:h_start + new_h, w_start:w_start + new_w]
+        if new_w != old_w or new_h != old_h:
+            cv2.resize(image, (new_w, new_h), dst=roi, interpolation=interpolation)
+        else:
+            roi[...] = image
+
+        return canvas
     
     @staticmethod
     def _aspectaware_resize_padding(image, width, height, interpolation=None, means=None):
@@ -71,12 +158,7 @@ class Preprocess(object):
         """
 
         old_h, old_w, _ = image.shape
-        if old_w > old_h:
-            new_w = width
-            new_h = int(width / old_w * old_h)
-        else:
-            new_w = int(height / old_h * old_w)
-            new_h = height
+        new_w, new_h, w_start, h_start = Preprocess._letterbox_plan(old_h, old_w, width, height)
         
         # resize the image by maintaining aspect ratio
         if new_w != old_w or new_h != old_h:
@@ -88,16 +170,39 @@ class Preprocess(object):
         padding_h = height - new_h
         padding_w = width - new_w
 
-        # parameter for inserting resized image to the middle of canvas
-        h_start = max(0, height - new_h) // 2
-        w_start = max(0, width - new_w) // 2
-
         # pad the resized-contrast ratio maintained image to get desired dimensions
         image = cv2.copyMakeBorder(image, h_start, h_start, w_start, w_start, cv2.BORDER_CONSTANT, value=[means, means, means])
 
         return image, new_w, new_h, old_w, old_h, padding_w, padding_h,
 
-    def __call__(self, img):
+    @staticmethod
+    def _normalize(canvas, out=None):
+        """
+        HWC -> CHW, uint8 -> float32 and scaling to [0, 1] fused in a single pass
+        Parameters
+        ----------
+        canvas      : numpy array
+                      uint8 numpy array of shape (H, W, 3)
+        out         : numpy array
+                      float32 numpy array of shape (1, 3, H, W) or (3, H, W) to write into,
+                      newly allocated as (1, 3, H, W) if None
+        
+        Returns
+        -------
+        out         : numpy array
+                      float32 numpy array, same values as astype(np.float32) / 255.0
+        """
+        if out is None:
+            out = np.empty((1, canvas.shape[2]) + canvas.shape[:2], dtype=np.float32)
+        chw = out[0] if out.ndim == 4 else out
+
+        # deinterleave in uint8 (cheap), then every float32 plane is written exactly once, contiguously
+        for channel, plane in enumerate(cv2.split(canvas)):
+            np.divide(plane, np.float32(255.0), out=chw[channel], dtype=np.float32, casting="unsafe")
+
+        return out
+
+    def __call__(self, img, out=None):
         """
         Preprocess an image for YOLOv5 TensorRT model inferencing.
         Parameters
@@ -105,48 +210,123 @@ class Preprocess(object):
         img         : numpy array
                       In BGR format
                       uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional float32 buffer of shape (1, 3, H, W) or (3, H, W),
+                      e.g a slot of a batch tensor, to write the preprocessed image into
         
         Returns
         -------
         img         : numpy array
                       preprocessed image
-                      float32 numpy array of shape (3, H, W)
+                      float32 numpy array of shape (1, 3, H, W), or `out` if given
         metas       : list
                       list containing additional informations about the image
         """
         # resize the image and pad the image by maintaining contrast ratio
-        img_meta = self._aspectaware_resize_padding(image=img, width=self.input_size, 
-                                            height=self.input_size, interpolation=cv2.INTER_LINEAR, means=self.fill_value)
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
 
-        img = np.transpose(img_meta[0], (2, 0, 1)).astype(np.float32)
-        img = np.expand_dims(img, axis=0)
-        img /= 255.0
+        img = self._normalize(canvas, out=out)
 
         return img
 
-def preprocessor_proc(video, fqueue, bqueue):
-    # Write the frames, read with opencv, to the queue
+    def letterbox(self, img, out=None):
+        """
+        Letterbox an image to CHW without normalizing it, the uint8 canvas is 4x smaller than
+        the float32 tensor and dividing by 255 can be done when it is loaded
+        Parameters
+        ----------
+        img         : numpy array
+                      In BGR format
+                      uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional uint8 buffer of shape (1, 3, H, W) or (3, H, W) to write into
+        
+        Returns
+        -------
+        img         : numpy array
+                      letterboxed image
+                      uint8 numpy array of shape (1, 3, H, W), or `out` if given
+        """
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
+
+        if out is None:
+            out = np.empty((1, 3, self.input_size, self.input_size), dtype=np.uint8)
+        chw = out[0] if out.ndim == 4 else out
+        cv2.split(canvas, list(chw))
+
+        return out
+
+    def batch(self, frames, out=None):
+        """
+        Preprocess a group of images, of any mix of resolutions, into one batch tensor.
+        Every frame is letterboxed and normalized straight into its row of the batch, no
+        staging copy of the whole stack is made.
+        For callers that already hold a group of raw frames. The readers preprocess every frame
+        as soon as it is decoded, into its queue slot, so that preprocessing overlaps decoding and
+        no frame waits for the rest of a batch, grouping them would not make it cheaper.
+        Parameters
+        ----------
+        frames      : list or numpy array
+                      In BGR format
+                      uint8 numpy arrays of shape (img_h, img_w, 3), or a stack of them
+        out         : numpy array
+                      optional float32 buffer of shape (len(frames), 3, H, W),
+                      e.g a view of a preallocated batch tensor, to write the batch into
+        
+        Returns
+        -------
+        img         : numpy array
+                      preprocessed images
+                      float32 numpy array of shape (len(frames), 3, H, W), or `out` if given
+        """
+        if out is None:
+            out = np.empty((len(frames), 3, self.input_size, self.input_size), dtype=np.float32)
+
+        for i, frame in enumerate(frames):
+            self(frame, out=out[i])
+
+        return out
+
+def preprocessor_proc(video, fqueue, metrics, stream):
+    # Write the frames, read with opencv, to the queue, each with its decode to enqueue stamps
     video_path = os.path.abspath(video)
 
     vidcap = cv2.VideoCapture(video_path)
-    vidname = os.path.splitext(video_path)[0].split("/")[-1]
     # create an instance of the preprocess class
     preprocessor = Preprocess(input_size=640) 
 
     while True: 
-        r_start_t = time.time()
+        decode_t = time.perf_counter()
         success, frame = vidcap.read()
         if not success:
             fqueue.put("DONE")
             break
         else:
+            # frames go through the queue itself, there is no ring slot to wait for, acquire takes no time
+            preprocess_t = time.perf_counter()
             np_frame = preprocessor(frame)
-            fqueue.put(np_frame)
-            print("Writer {} Queue Length : {}".format(vidname, fqueue.qsize()))
-        r_start_e = time.time()
-        bqueue.put(r_start_e - r_start_t)
+            # counted before the put, the consumer can take the frame as soon as it is on the queue
+            metrics.produced(stream)
+            fqueue.put((np_frame, (decode_t, preprocess_t, preprocess_t, time.perf_counter())))
+
+def receive(queue, metrics, stream):
+    # Next frame of a queue and its stamps up to dequeue, "DONE" and no stamps at the end of the stream
+    msg = queue.get()
+    if isinstance(msg, str):
+        return msg, None
+    metrics.consumed(stream)
+    frame, stamps = msg
+    return frame, list(stamps) + [time.perf_counter()]
 
-def batch_multiplex_proc(first_queue, second_queue):
+def save_traced(npy_path, batch_array, traced, batch_t, tracer):
+    # Save a batch, then record every frame of it, `traced` holds (stream, stamps up to dequeue) pairs
+    write_t = time.perf_counter()
+    np.save(npy_path, batch_array)
+    done_t = time.perf_counter()
+    for stream, stamps in traced:
+        tracer.record(stream, stamps + [batch_t, write_t, done_t])
+
+def batch_multiplex_proc(first_queue, second_queue, tracer, metrics):
     
     # Read from multiple queues, this will be spawned as a seperate process
 
@@ -158,14 +338,14 @@ def batch_multiplex_proc(first_queue, second_queue):
     while True:
         # get data from noth queue simultaneously
         if first and second:
-            first_frame = first_queue.get()
-            second_frame = second_queue.get()
+            first_frame, first_stamps = receive(first_queue, metrics, 0)
+            second_frame, second_stamps = receive(second_queue, metrics, 1)
         elif first and not second:
-            first_frame = first_queue.get()
+            first_frame, first_stamps = receive(first_queue, metrics, 0)
             second_frame = "DONE"
         elif not first and second:
             first_frame = "DONE"
-            second_frame = second_queue.get()
+            second_frame, second_stamps = receive(second_queue, metrics, 1)
         else:
             first_frame = "DONE"
             second_frame = "DONE"
@@ -175,30 +355,21 @@ def batch_multiplex_proc(first_queue, second_queue):
 
         if isinstance(first_frame, np.ndarray) and isinstance(second_frame, np.ndarray):
             batch_array = np.vstack((first_frame, second_frame))
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
+            save_traced(npy_path, batch_array, [(0, first_stamps), (1, second_stamps)], time.perf_counter(), tracer)
             count += 1
-            print("Batch")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
+            metrics.batched()
         elif isinstance(first_frame, np.ndarray) and second_frame == "DONE":
             batch_array = first_frame
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
+            save_traced(npy_path, batch_array, [(0, first_stamps)], time.perf_counter(), tracer)
             count += 1
             second = False
-            print("Single")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
+            metrics.batched()
         elif isinstance(second_frame, np.ndarray) and first_frame == "DONE":
             batch_array = second_frame
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
+            save_traced(npy_path, batch_array, [(1, second_stamps)], time.perf_counter(), tracer)
             count += 1
             first = False
-            print("Single")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
+            metrics.batched()
         else:
             break
 
@@ -206,24 +377,32 @@ def batch_multiplex_proc(first_queue, second_queue):
 if __name__=='__main__':
     fqueue = Queue()  # preprocessor_proc() writes to this queue associated with its video stream from _this_ process    
     squeue = Queue()  # preprocessor_proc() writes to this queue associated with its video stream from _this_ process    
-    fbqueue = Queue()
-    sbqueue = Queue()
+
+    # queue depths, rates and batch sizes, sampled and printed once a second by a side thread
+    metrics = QueueMetrics(["1", "2"], interval=1.0)
 
     # Reader processes that write into it's respective queues
-    stream1_p = Process(target=preprocessor_proc, args=("videos/1.mp4", fqueue, fbqueue)) # send video path and queue as args to proc
-    stream2_p = Process(target=preprocessor_proc, args=("videos/2.mp4", squeue, sbqueue)) # send video path and queue as args to proc
+    stream1_p = Process(target=preprocessor_proc, args=("videos/1.mp4", fqueue, metrics, 0)) # send video path, queue and counters as args to proc
+    stream2_p = Process(target=preprocessor_proc, args=("videos/2.mp4", squeue, metrics, 1)) # send video path, queue and counters as args to proc
     stream1_p.daemon = True
     stream2_p.daemon = True
 
     stream1_p.start() # Launch stream1 grasp/ preprocess operations as seperate python process since they are independent
     stream2_p.start() # Launch stream1 grasp/ preprocess operations as seperate python process since they are independent
 
-    batch_multiplex_proc(fqueue, squeue)
+    # the frame times used to go through a second queue per process, read back with Queue.queue, which
+    # multiprocessing queues do not have, the stamps now travel with the frames into latency histograms
+    tracer = FrameTracer(["1", "2"])
+    tracer.dump_on("data/queue/trace.json")
+
+    metrics.start()
+    batch_multiplex_proc(fqueue, squeue, tracer, metrics)
+    metrics.stop()
 
-    fprepro_np = np.array(list(fbqueue.queue))
-    sprepro_np = np.array(list(sbqueue.queue))
-    print("First process one frame time : {}".format(np.average(fprepro_np)))
-    print("Second process one frame time : {}".format(np.average(sprepro_np)))
+    stages = tracer.report()["stages"]
+    for stream, name in [("1", "First"), ("2", "Second")]:
+        print("{} process one frame time : {:.4f}s decode, {:.4f}s preprocess".format(
+            name, stages["decode"][stream]["mean"], stages["preprocess"][stream]["mean"]))
 
     stream1_p.join()
-    stream2_p.join()
\ No newline at end of file
+    stream2_p.join()
@@ -5,17 +5,26 @@ https://stackoverflow.com/questions/11515944/how-to-use-multiprocessing-queue-in
 2. Python multiprocessing
 3. Pytorch multiprocessing
 4. Bounded Buffer problem
+5. Shared memory ring buffer (https://docs.python.org/3/library/multiprocessing.shared_memory.html)
 """
 
 import os
 import sys
 import time
+import functools
+from queue import Empty, LifoQueue
 from typing import List, Tuple
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Semaphore
+from multiprocessing.shared_memory import SharedMemory
 
 import cv2
 import numpy as np
 
+from frame_store import AsyncFrameStoreWriter
+from ffmpeg_source import FFmpegVideoCapture
+from frame_trace import STAGES, FrameTracer
+from queue_metrics import QueueMetrics
+
 class Preprocess(object):
     
     def __init__(self, input_size, fill_value : int =128):
@@ -35,6 +44,89 @@ class Preprocess(object):
         if isinstance(self.input_size, List) or isinstance(self.input_size, Tuple):
             assert self.input_size[0] == self.input_size[1] , "Input weight and width are not the same."
             self.input_size = int(self.input_size[0])
+
+        # letterbox geometry per input frame shape, a fixed camera only ever computes it once
+        self._plans = {}
+        # reused letterbox canvas per geometry, its padding areas are filled once at creation
+        self._canvases = {}
+
+    @staticmethod
+    def _letterbox_plan(old_h, old_w, width, height):
+        """
+        Compute the geometry of the aspect-aware resize for a frame shape
+        Parameters
+        ----------
+        old_h         : int
+                        height, of the image before resizing
+        old_w         : int
+                        width, of the image before resizing
+        width         : int
+                        width of newly padded image
+        height        : int
+                        height of newly padded image
+        
+        Returns
+        -------
+        new_w         : int
+                        width, of the image after resizing without losing aspect ratio
+        new_h         : int
+                        height, of the image after resizing without losing aspect ratio
+        w_start       : int
+                        column of the canvas where the resized image starts
+        h_start       : int
+                        row of the canvas where the resized image starts
+        """
+        if old_w > old_h:
+            new_w = width
+            new_h = int(width / old_w * old_h)
+        else:
+            new_w = int(height / old_h * old_w)
+            new_h = height
+
+        # parameter for inserting resized image to the middle of canvas
+        h_start = max(0, height - new_h) // 2
+        w_start = max(0, width - new_w) // 2
+
+        return new_w, new_h, w_start, h_start
+
+    def _letterbox(self, image, interpolation=cv2.INTER_LINEAR):
+        """
+        Resize the image straight into the centre of a reused canvas whose padding areas
+        are already filled, so neither the resized image nor the border is allocated per frame.
+        Every input frame shape gets its own canvas, so mixed resolutions never refill them
+        Parameters
+        ----------
+        image         : numpy array
+                        In BGR format
+                        uint8 numpy array of shape (img_h, img_w, 3)
+        interpolation : int
+                        method, to be applied on the image for resizing
+        
+        Returns
+        -------
+        canvas        : numpy array
+                        uint8 numpy array of shape (input_size, input_size, 3),
+                        overwritten by the next call with the same frame shape
+        """
+        old_h, old_w = image.shape[:2]
+        plan = self._plans.get((old_h, old_w))
+        if plan is None:
+            plan = self._letterbox_plan(old_h, old_w, self.input_size, self.input_size)
+            self._plans[(old_h, old_w)] = plan
+        new_w, new_h, w_start, h_start = plan
+
+        canvas = self._canvases.get(plan)
+        if canvas is None:
+            canvas = np.full((self.input_size, self.input_size, 3), self.fill_value, dtype=np.uint8)
+            self._canvases[plan] = canvas
+
+        roi = canvas[h_start:h_start + new_h, w_start:w_start + new_w]
+        if new_w != old_w or new_h != old_h:
+            cv2.resize(image, (new_w, new_h), dst=roi, interpolation=interpolation)
+        else:
+            roi[...] = image
+
+        return canvas
     
     @staticmethod
     def _aspectaware_resize_padding(image, width, height, interpolation=None, means=None):
@@ -71,12 +163,7 @@ class Preprocess(object):
         """
 
         old_h, old_w, _ = image.shape
-        if old_w > old_h:
-            new_w = width
-            new_h = int(width / old_w * old_h)
-        else:
-            new_w = int(height / old_h * old_w)
-            new_h = height
+        new_w, new_h, w_start, h_start = Preprocess._letterbox_plan(old_h, old_w, width, height)
         
         # resize the image by maintaining aspect ratio
         if new_w != old_w or new_h != old_h:
@@ -88,16 +175,39 @@ class Preprocess(object):
         padding_h = height - new_h
         padding_w = width - new_w
 
-        # parameter for inserting resized image to the middle of canvas
-        h_start = max(0, height - new_h) // 2
-        w_start = max(0, width - new_w) // 2
-
         # pad the resized-contrast ratio maintained image to get desired dimensions
         image = cv2.copyMakeBorder(image, h_start, h_start, w_start, w_start, cv2.BORDER_CONSTANT, value=[means, means, means])
 
         return image, new_w, new_h, old_w, old_h, padding_w, padding_h,
 
-    def __call__(self, img):
+    @staticmethod
+    def _normalize(canvas, out=None):
+        """
+        HWC -> CHW, uint8 -> float32 and scaling to [0, 1] fused in a single pass
+        Parameters
+        ----------
+        canvas      : numpy array
+                      uint8 numpy array of shape (H, W, 3)
+        out         : numpy array
+                      float32 numpy array of shape (1, 3, H, W) or (3, H, W) to write into,
+                      newly allocated as (1, 3, H, W) if None
+        
+        Returns
+        -------
+        out         : numpy array
+                      float32 numpy array, same values as astype(np.float32) / 255.0
+        """
+        if out is None:
+            out = np.empty((1, canvas.shape[2]) + canvas.shape[:2], dtype=np.float32)
+        chw = out[0] if out.ndim == 4 else out
+
+        # deinterleave in uint8 (cheap), then every float32 plane is written exactly once, contiguously
+        for channel, plane in enumerate(cv2.split(canvas)):
+            np.divide(plane, np.float32(255.0), out=chw[channel], dtype=np.float32, casting="unsafe")
+
+        return out
+
+    def __call__(self, img, out=None):
         """
         Preprocess an image for YOLOv5 TensorRT model inferencing.
         Parameters
@@ -105,115 +215,374 @@ class Preprocess(object):
         img         : numpy array
                       In BGR format
                       uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional float32 buffer of shape (1, 3, H, W) or (3, H, W),
+                      e.g a slot of a batch tensor, to write the preprocessed image into
         
         Returns
         -------
         img         : numpy array
                       preprocessed image
-                      float32 numpy array of shape (3, H, W)
+                      float32 numpy array of shape (1, 3, H, W), or `out` if given
         metas       : list
                       list containing additional informations about the image
         """
         # resize the image and pad the image by maintaining contrast ratio
-        img_meta = self._aspectaware_resize_padding(image=img, width=self.input_size, 
-                                            height=self.input_size, interpolation=cv2.INTER_LINEAR, means=self.fill_value)
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
 
-        img = np.transpose(img_meta[0], (2, 0, 1)).astype(np.float32)
-        img = np.expand_dims(img, axis=0)
-        img /= 255.0
+        img = self._normalize(canvas, out=out)
 
         return img
 
-def preprocessor_proc(video, queue):
-    # Write the frames, read with opencv, to the queue
+    def letterbox(self, img, out=None):
+        """
+        Letterbox an image to CHW without normalizing it, the uint8 canvas is 4x smaller than
+        the float32 tensor and dividing by 255 can be done when it is loaded
+        Parameters
+        ----------
+        img         : numpy array
+                      In BGR format
+                      uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional uint8 buffer of shape (1, 3, H, W) or (3, H, W) to write into
+        
+        Returns
+        -------
+        img         : numpy array
+                      letterboxed image
+                      uint8 numpy array of shape (1, 3, H, W), or `out` if given
+        """
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
+
+        if out is None:
+            out = np.empty((1, 3, self.input_size, self.input_size), dtype=np.uint8)
+        chw = out[0] if out.ndim == 4 else out
+        cv2.split(canvas, list(chw))
+
+        return out
+
+    def batch(self, frames, out=None):
+        """
+        Preprocess a group of images, of any mix of resolutions, into one batch tensor.
+        Every frame is letterboxed and normalized straight into its row of the batch, no
+        staging copy of the whole stack is made.
+        For callers that already hold a group of raw frames. The readers preprocess every frame
+        as soon as it is decoded, into its queue slot, so that preprocessing overlaps decoding and
+        no frame waits for the rest of a batch, grouping them would not make it cheaper.
+        Parameters
+        ----------
+        frames      : list or numpy array
+                      In BGR format
+                      uint8 numpy arrays of shape (img_h, img_w, 3), or a stack of them
+        out         : numpy array
+                      optional float32 buffer of shape (len(frames), 3, H, W),
+                      e.g a view of a preallocated batch tensor, to write the batch into
+        
+        Returns
+        -------
+        img         : numpy array
+                      preprocessed images
+                      float32 numpy array of shape (len(frames), 3, H, W), or `out` if given
+        """
+        if out is None:
+            out = np.empty((len(frames), 3, self.input_size, self.input_size), dtype=np.float32)
+
+        for i, frame in enumerate(frames):
+            self(frame, out=out[i])
+
+        return out
+
+class SharedFrameRing(object):
+
+    def __init__(self, num_slots : int, frame_shape, dtype=np.float32):
+        """
+        Fixed-slot ring buffer of frames living in shared memory.
+        A single producer writes frames into the slots in order and only sends the
+        sequence number of the frame through a queue, the consumer reads the slot
+        in place (zero-copy) and releases it once the frame is no longer needed.
+        Every slot also holds the STAGES stamps of its frame, see frame_trace.
+        Parameters
+        ----------
+        num_slots   : int
+                      number of frames the ring can hold at once,
+                      producer blocks when all of the slots are in use
+        frame_shape : tuple
+                      shape of a single frame, e.g (1, 3, 640, 640)
+        dtype       : numpy dtype
+                      data type of the frames
+        """
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+
+        nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize * self.num_slots
+        self._stamps_offset = (nbytes + 7) // 8 * 8  # stamps follow the frames, 8 byte aligned
+        self.shm = SharedMemory(create=True, size=self._stamps_offset + self.num_slots * len(STAGES) * 8)
+        self.free_slots = Semaphore(self.num_slots)
+        self._attach()
+
+    def _attach(self):
+        self.slots = np.ndarray((self.num_slots,) + self.frame_shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.stamps = np.ndarray((self.num_slots, len(STAGES)), dtype=np.float64, buffer=self.shm.buf,
+                                 offset=self._stamps_offset)
+
+    def __getstate__(self):
+        # only send the name of the shared memory block to the child processes, never the frames
+        state = self.__dict__.copy()
+        del state["slots"]
+        del state["stamps"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def acquire(self, seq : int):
+        """
+        Wait for a free slot and return the writable frame for sequence number `seq`.
+        """
+        self.free_slots.acquire()
+        return self.slots[seq % self.num_slots]
+
+    def frame(self, seq : int):
+        """
+        Zero-copy view of the frame written for sequence number `seq`.
+        """
+        return self.slots[seq % self.num_slots]
+
+    def stamp(self, seq : int):
+        """
+        The STAGES stamps of the frame with sequence number `seq`, written in place, valid as long as its slot is held.
+        """
+        return self.stamps[seq % self.num_slots]
+
+    def release(self):
+        """
+        Hand the oldest slot held by the consumer back to the producer.
+        """
+        self.free_slots.release()
+
+    def close(self):
+        del self.slots
+        del self.stamps
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+class BatchBufferPool(object):
+
+    def __init__(self, num_buffers : int, max_batch_size : int, frame_shape, dtype=np.float32):
+        """
+        Pool of preallocated batch tensors, recycled between the multiplexer and its sink.
+        Frames are written into a free buffer in place and short batches are views of it,
+        so no batch array is allocated after start up.
+        Parameters
+        ----------
+        num_buffers    : int
+                         number of batch tensors, multiplexer blocks when all of them are in use
+        max_batch_size : int
+                         first dimension of every batch tensor
+        frame_shape    : tuple
+                         shape of a single frame, e.g (3, 640, 640)
+        dtype          : numpy dtype
+                         data type of the batch tensors
+        """
+        self.free_buffers = LifoQueue()  # hand out the most recently used buffer first, it is still warm in cache
+        for _ in range(num_buffers):
+            self.free_buffers.put(np.empty((max_batch_size,) + tuple(frame_shape), dtype=dtype))
+
+    def acquire(self):
+        """
+        Wait until the sink gave a batch tensor back and return it.
+        """
+        return self.free_buffers.get()
+
+    def release(self, buffer):
+        """
+        Give a batch tensor, or any view of it, back to the pool once the sink is done with it.
+        """
+        while buffer.base is not None:
+            buffer = buffer.base
+        self.free_buffers.put(buffer)
+
+def preprocessor_proc(video, queue, ring, backend : str ="opencv", metrics=None, stream : int =0):
+    # Write the frames, read with opencv or an ffmpeg rawvideo pipe, to the queue,
+    # counted as produced by `stream` in the QueueMetrics if any, nothing is printed per frame
     video_path = os.path.abspath(video)
 
-    vidcap = cv2.VideoCapture(video_path)
-    vidname = os.path.splitext(video_path)[0].split("/")[-1]
+    vidcap = FFmpegVideoCapture(video_path) if backend == "ffmpeg" else cv2.VideoCapture(video_path)
     # create an instance of the preprocess class
     preprocessor = Preprocess(input_size=640) 
 
+    seq = 0
     while True: 
+        decode_t = time.perf_counter()
         success, frame = vidcap.read()
         if not success:
             queue.put("DONE")
             break
         else:
-            np_frame = preprocessor(frame)
-            queue.put(np_frame)
-            print("Writer {} Queue Length : {}".format(vidname, queue.qsize()))
+            # waiting for a free slot is its own stage, not part of decoding or preprocessing
+            acquire_t = time.perf_counter()
+            slot = ring.acquire(seq)
+            preprocess_t = time.perf_counter()
+            # write the frame straight into shared memory and only send its sequence number,
+            # uint8 rings carry letterboxed canvases that are normalized when they are loaded
+            if ring.dtype == np.uint8:
+                preprocessor.letterbox(frame, out=slot)
+            else:
+                preprocessor(frame, out=slot)
+            # the decode to enqueue stamps travel in the slot, written before the consumer can see it
+            ring.stamp(seq)[:4] = (decode_t, acquire_t, preprocess_t, time.perf_counter())
+            # counted before the put, the consumer can take the frame as soon as it is on the queue
+            if metrics is not None:
+                metrics.produced(stream)
+            queue.put(seq)
+            seq += 1
 
-def batch_multiplex_proc(first_queue, second_queue):
-    
-    # Read from multiple queues, this will be spawned as a seperate process
+    vidcap.release()
+    ring.close()
 
-    # make a batch numpy array and save it as a npy file
+def _traced_release(pool, tracer, streams, stamps, buffer):
+    # writer thread callback of a traced batch, stamps its frames done, records them and gives the buffer back
+    stamps[:, -1] = time.perf_counter()
+    for stream, frame_stamps in zip(streams, stamps):
+        tracer.record(stream, frame_stamps)
+    pool.release(buffer)
+
+def batch_multiplex_proc(queues, rings, max_batch_size : int =8, max_wait : float =0.05, poll_interval : float =0.001,
+                         num_buffers : int =4, num_writers : int =1, tracer=None, metrics=None):
+    """
+    Read frames from any number of stream queues and save them in dynamic batches.
+    A batch is flushed as soon as it holds `max_batch_size` frames or `max_wait` seconds
+    passed since its first frame arrived, so a slow stream never stalls the others.
+    Streams that sent "DONE" leave the batch, the multiplexer returns once all of them did.
+    Parameters
+    ----------
+    queues         : list
+                     one queue per stream, carrying sequence numbers of the frames
+    rings          : list
+                     one SharedFrameRing per stream, holding the frames themselves
+    max_batch_size : int
+                     maximum number of frames in a batch
+    max_wait       : float
+                     latency deadline in seconds, measured from the first frame of the batch
+    poll_interval  : float
+                     sleep time in seconds when none of the streams has a frame ready
+    num_buffers    : int
+                     number of preallocated batch tensors shared with the sink
+    num_writers    : int
+                     number of background threads writing the batches to disk
+    tracer         : FrameTracer
+                     optional, records the latency of every stage of every frame, see frame_trace
+    metrics        : QueueMetrics
+                     optional, counts the frames consumed from every stream and the batches, see queue_metrics
+    """
     count = 0
-    first = True
-    second = True
-
-    while True:
-        # get data from noth queue simultaneously
-        if first and second:
-            first_frame = first_queue.get()
-            second_frame = second_queue.get()
-        elif first and not second:
-            first_frame = first_queue.get()
-            second_frame = "DONE"
-        elif not first and second:
-            first_frame = "DONE"
-            second_frame = second_queue.get()
-        else:
-            first_frame = "DONE"
-            second_frame = "DONE"
-
-        # Configure npy file path
-        npy_path = "%s/%s/out-%04d.npy" % ("data", "queue", count)
-
-        if isinstance(first_frame, np.ndarray) and isinstance(second_frame, np.ndarray):
-            batch_array = np.vstack((first_frame, second_frame))
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
-            count += 1
-            print("Batch")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
-        elif isinstance(first_frame, np.ndarray) and second_frame == "DONE":
-            batch_array = first_frame
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
-            count += 1
-            second = False
-            print("Single")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
-        elif isinstance(second_frame, np.ndarray) and first_frame == "DONE":
-            batch_array = second_frame
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
-            count += 1
-            first = False
-            print("Single")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
-        else:
-            break
+    active = list(range(len(queues)))
+    pool = BatchBufferPool(num_buffers, max_batch_size, rings[0].frame_shape[1:], dtype=rings[0].dtype)
+    # every batch goes into one append-only store instead of one npy file per batch
+    store = AsyncFrameStoreWriter("%s/%s/frames" % ("data", "queue"), frame_shape=rings[0].frame_shape[1:], dtype=rings[0].dtype,
+                                  fields=("batch", "stream", "frame"), num_workers=num_writers, max_pending=num_buffers)
+
+    while active:
+        batch = []  # (stream, seq) pairs of the frames in the batch
+        deadline = None
+        buffer = pool.acquire()
+        if tracer is not None:
+            stamps = np.empty((max_batch_size, len(STAGES)))  # STAGES stamps of every row of the batch
+
+        while active and len(batch) < max_batch_size:
+            received = False
+            # poll every live stream once per pass, so each stream gets a fair share of the batch
+            for stream in list(active):
+                try:
+                    msg = queues[stream].get_nowait()
+                except Empty:
+                    continue
+                received = True
+                if msg == "DONE":
+                    active.remove(stream)
+                    continue
+                dequeue_t = time.perf_counter()
+                if metrics is not None:
+                    metrics.consumed(stream)
+                # copy the frame into its row of the batch tensor and hand the slot back to the producer
+                buffer[len(batch):len(batch) + 1] = rings[stream].frame(msg)
+                if tracer is not None:
+                    # the producer's stamps are only valid while the slot is held
+                    stamps[len(batch), :4] = rings[stream].stamp(msg)[:4]
+                    stamps[len(batch), 4:6] = (dequeue_t, time.perf_counter())
+                rings[stream].release()
+                batch.append((stream, msg))
+                if deadline is None:
+                    deadline = time.time() + max_wait
+                if len(batch) == max_batch_size:
+                    break
+
+            if deadline is not None and time.time() >= deadline:
+                break
+            if not received:
+                time.sleep(poll_interval)
+
+        if not batch:
+            pool.release(buffer)
+            continue
+
+        batch_array = buffer[:len(batch)]  # short batches are a view of the full tensor
+        on_done = pool.release
+        if tracer is not None:
+            stamps[:len(batch), 6] = time.perf_counter()
+            on_done = functools.partial(_traced_release, pool, tracer, [stream for stream, _ in batch], stamps[:len(batch)])
+        # batch, source stream and frame number of every row, the writer hands the buffer back to the pool
+        store.append(batch_array, keys=[(count, stream, index) for stream, index in batch], on_done=on_done)
+        count += 1
+        if metrics is not None:
+            metrics.batched()
+
+    store.close()
+    print("Writer saved {saved_time:.3f}s of the batching loop ({write_time:.3f}s writing, {wait_time:.3f}s waiting)".format(**store.report()))
 
 
 if __name__=='__main__':
-    fqueue = Queue()  # preprocessor_proc() writes to this queue associated with its video stream from _this_ process    
-    squeue = Queue()  # preprocessor_proc() writes to this queue associated with its video stream from _this_ process    
+    videos = ["videos/1.mp4", "videos/2.mp4"]
+    storage = np.float32  # np.uint8 moves and saves letterboxed canvases, 4x less data, FrameStore.load normalizes them
+    backend = "opencv"    # "ffmpeg" decodes through an ffmpeg rawvideo pipe into preallocated frame buffers
+
+    names = [os.path.splitext(os.path.basename(video))[0] for video in videos]
+    # queue depths, rates and drops of every stream, sampled and printed once a second by a side thread
+    metrics = QueueMetrics(names, interval=1.0)
+
+    queues = []     # preprocessor_proc() writes to the queue associated with its video stream from _this_ process
+    rings = []      # frames of every stream, only slot numbers go through the queues
+    streams = []    # reader processes that write into it's respective queues and rings
+    for i, video in enumerate(videos):
+        queue = Queue()
+        ring = SharedFrameRing(num_slots=8, frame_shape=(1, 3, 640, 640), dtype=storage)
+        stream_p = Process(target=preprocessor_proc, args=(video, queue, ring, backend, metrics, i, )) # send video path, queue, ring, decoder and counters as args to proc
+        stream_p.daemon = True
+        queues.append(queue)
+        rings.append(ring)
+        streams.append(stream_p)
+
+    for stream_p in streams:
+        stream_p.start() # Launch grasp/ preprocess operations as seperate python process since they are independent
 
-    # Reader processes that write into it's respective queues
-    stream1_p = Process(target=preprocessor_proc, args=("videos/1.mp4", fqueue, )) # send video path and queue as args to proc
-    stream2_p = Process(target=preprocessor_proc, args=("videos/2.mp4", squeue, )) # send video path and queue as args to proc
-    stream1_p.daemon = True
-    stream2_p.daemon = True
+    # latency histograms of every stage, dumped at exit and on kill -USR1, a .prom path writes the Prometheus format
+    tracer = FrameTracer(names)
+    tracer.dump_on("data/queue/trace.json")
 
-    stream1_p.start() # Launch stream1 grasp/ preprocess operations as seperate python process since they are independent
-    stream2_p.start() # Launch stream1 grasp/ preprocess operations as seperate python process since they are independent
+    metrics.start()
+    batch_multiplex_proc(queues, rings, max_batch_size=8, max_wait=0.05, tracer=tracer, metrics=metrics)
+    metrics.stop()
+    total = tracer.report()["stages"]["total"]["all"]
+    print("Frame latency, decode to disk : p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+        1000 * total["p50"], 1000 * total["p99"], 1000 * total["max"]))
 
-    batch_multiplex_proc(fqueue, squeue)
+    for stream_p in streams:
+        stream_p.join()
 
-    stream1_p.join()
-    stream2_p.join()
\ No newline at end of file
+    for ring in rings:
+        ring.close()
+        ring.unlink()
@@ -10,12 +10,16 @@ import os
 import time
 import threading
 import subprocess as sp
-from queue import Queue
+from queue import Queue, Empty, LifoQueue
 from typing import List, Tuple
 
 import cv2
 import numpy as np
 
+from frame_store import AsyncFrameStoreWriter
+from ffmpeg_source import FFmpegVideoCapture
+from queue_metrics import QueueMetrics
+
 class Preprocess(object):
     
     def __init__(self, input_size, fill_value : int =128):
@@ -35,6 +39,89 @@ class Preprocess(object):
         if isinstance(self.input_size, List) or isinstance(self.input_size, Tuple):
             assert self.input_size[0] == self.input_size[1] , "Input weight and width are not the same."
             self.input_size = int(self.input_size[0])
+
+        # letterbox geometry per input frame shape, a fixed camera only ever computes it once
+        self._plans = {}
+        # reused letterbox canvas per geometry, its padding areas are filled once at creation
+        self._canvases = {}
+
+    @staticmethod
+    def _letterbox_plan(old_h, old_w, width, height):
+        """
+        Compute the geometry of the aspect-aware resize for a frame shape
+        Parameters
+        ----------
+        old_h         : int
+                        height, of the image before resizing
+        old_w         : int
+                        width, of the image before resizing
+        width         : int
+                        width of newly padded image
+        height        : int
+                        height of newly padded image
+        
+        Returns
+        -------
+        new_w         : int
+                        width, of the image after resizing without losing aspect ratio
+        new_h         : int
+                        height, of the image after resizing without losing aspect ratio
+        w_start       : int
+                        column of the canvas where the resized image starts
+        h_start       : int
+                        row of the canvas where the resized image starts
+        """
+        if old_w > old_h:
+            new_w = width
+            new_h = int(width / old_w * old_h)
+        else:
+            new_w = int(height / old_h * old_w)
+            new_h = height
+
+        # parameter for inserting resized image to the middle of canvas
+        h_start = max(0, height - new_h) // 2
+        w_start = max(0, width - new_w) // 2
+
+        return new_w, new_h, w_start, h_start
+
+    def _letterbox(self, image, interpolation=cv2.INTER_LINEAR):
+        """
+        Resize the image straight into the centre of a reused canvas whose padding areas
+        are already filled, so neither the resized image nor the border is allocated per frame.
+        Every input frame shape gets its own canvas, so mixed resolutions never refill them
+        Parameters
+        ----------
+        image         : numpy array
+                        In BGR format
+                        uint8 numpy array of shape (img_h, img_w, 3)
+        interpolation : int
+                        method, to be applied on the image for resizing
+        
+        Returns
+        -------
+        canvas        : numpy array
+                        uint8 numpy array of shape (input_size, input_size, 3),
+                        overwritten by the next call with the same frame shape
+        """
+        old_h, old_w = image.shape[:2]
+        plan = self._plans.get((old_h, old_w))
+        if plan is None:
+            plan = self._letterbox_plan(old_h, old_w, self.input_size, self.input_size)
+            self._plans[(old_h, old_w)] = plan
+        new_w, new_h, w_start, h_start = plan
+
+        canvas = self._canvases.get(plan)
+        if canvas is None:
+            canvas = np.full((self.input_size, self.input_size, 3), self.fill_value, dtype=np.uint8)
+            self._canvases[plan] = canvas
+
+        roi = canvas[h_start:h_start + new_h, w_start:w_start + new_w]
+        if new_w != old_w or new_h != old_h:
+            cv2.resize(image, (new_w, new_h), dst=roi, interpolation=interpolation)
+        else:
+            roi[...] = image
+
+        return canvas
     
     @staticmethod
     def _aspectaware_resize_padding(image, width, height, interpolation=None, means=None):
@@ -71,12 +158,7 @@ class Preprocess(object):
         """
 
         old_h, old_w, _ = image.shape
-        if old_w > old_h:
-            new_w = width
-            new_h = int(width / old_w * old_h)
-        else:
-            new_w = int(height / old_h * old_w)
-            new_h = height
+        new_w, new_h, w_start, h_start = Preprocess._letterbox_plan(old_h, old_w, width, height)
         
         # resize the image by maintaining aspect ratio
         if new_w != old_w or new_h != old_h:
@@ -88,16 +170,39 @@ class Preprocess(object):
         padding_h = height - new_h
         padding_w = width - new_w
 
-        # parameter for inserting resized image to the middle of canvas
-        h_start = max(0, height - new_h) // 2
-        w_start = max(0, width - new_w) // 2
-
         # pad the resized-contrast ratio maintained image to get desired dimensions
         image = cv2.copyMakeBorder(image, h_start, h_start, w_start, w_start, cv2.BORDER_CONSTANT, value=[means, means, means])
 
         return image, new_w, new_h, old_w, old_h, padding_w, padding_h,
 
-    def __call__(self, img):
+    @staticmethod
+    def _normalize(canvas, out=None):
+        """
+        HWC -> CHW, uint8 -> float32 and scaling to [0, 1] fused in a single pass
+        Parameters
+        ----------
+        canvas      : numpy array
+                      uint8 numpy array of shape (H, W, 3)
+        out         : numpy array
+                      float32 numpy array of shape (1, 3, H, W) or (3, H, W) to write into,
+                      newly allocated as (1, 3, H, W) if None
+        
+        Returns
+        -------
+        out         : numpy array
+                      float32 numpy array, same values as astype(np.float32) / 255.0
+        """
+        if out is None:
+            out = np.empty((1, canvas.shape[2]) + canvas.shape[:2], dtype=np.float32)
+        chw = out[0] if out.ndim == 4 else out
+
+        # deinterleave in uint8 (cheap), then every float32 plane is written exactly once, contiguously
+        for channel, plane in enumerate(cv2.split(canvas)):
+            np.divide(plane, np.float32(255.0), out=chw[channel], dtype=np.float32, casting="unsafe")
+
+        return out
+
+    def __call__(self, img, out=None):
         """
         Preprocess an image for YOLOv5 TensorRT model inferencing.
         Parameters
@@ -105,36 +210,137 @@ class Preprocess(object):
         img         : numpy array
                       In BGR format
                       uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional float32 buffer of shape (1, 3, H, W) or (3, H, W),
+                      e.g a slot of a batch tensor, to write the preprocessed image into
         
         Returns
         -------
         img         : numpy array
                       preprocessed image
-                      float32 numpy array of shape (3, H, W)
+                      float32 numpy array of shape (1, 3, H, W), or `out` if given
         metas       : list
                       list containing additional informations about the image
         """
         # resize the image and pad the image by maintaining contrast ratio
-        img_meta = self._aspectaware_resize_padding(image=img, width=self.input_size, 
-                                            height=self.input_size, interpolation=cv2.INTER_LINEAR, means=self.fill_value)
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
 
-        img = np.transpose(img_meta[0], (2, 0, 1)).astype(np.float32)
-        img = np.expand_dims(img, axis=0)
-        img /= 255.0
+        img = self._normalize(canvas, out=out)
 
         return img
 
+    def letterbox(self, img, out=None):
+        """
+        Letterbox an image to CHW without normalizing it, the uint8 canvas is 4x smaller than
+        the float32 tensor and dividing by 255 can be done when it is loaded
+        Parameters
+        ----------
+        img         : numpy array
+                      In BGR format
+                      uint8 numpy array of shape (img_h, img_w, 3)
+        out         : numpy array
+                      optional uint8 buffer of shape (1, 3, H, W) or (3, H, W) to write into
+        
+        Returns
+        -------
+        img         : numpy array
+                      letterboxed image
+                      uint8 numpy array of shape (1, 3, H, W), or `out` if given
+        """
+        canvas = self._letterbox(img, interpolation=cv2.INTER_LINEAR)
+
+        if out is None:
+            out = np.empty((1, 3, self.input_size, self.input_size), dtype=np.uint8)
+        chw = out[0] if out.ndim == 4 else out
+        cv2.split(canvas, list(chw))
+
+        return out
+
+    def batch(self, frames, out=None):
+        """
+        Preprocess a group of images, of any mix of resolutions, into one batch tensor.
+        Every frame is letterboxed and normalized straight into its row of the batch, no
+        staging copy of the whole stack is made.
+        For callers that already hold a group of raw frames. The readers preprocess every frame
+        as soon as it is decoded, into its queue slot, so that preprocessing overlaps decoding and
+        no frame waits for the rest of a batch, grouping them would not make it cheaper.
+        Parameters
+        ----------
+        frames      : list or numpy array
+                      In BGR format
+                      uint8 numpy arrays of shape (img_h, img_w, 3), or a stack of them
+        out         : numpy array
+                      optional float32 buffer of shape (len(frames), 3, H, W),
+                      e.g a view of a preallocated batch tensor, to write the batch into
+        
+        Returns
+        -------
+        img         : numpy array
+                      preprocessed images
+                      float32 numpy array of shape (len(frames), 3, H, W), or `out` if given
+        """
+        if out is None:
+            out = np.empty((len(frames), 3, self.input_size, self.input_size), dtype=np.float32)
+
+        for i, frame in enumerate(frames):
+            self(frame, out=out[i])
+
+        return out
+
+
+class BatchBufferPool(object):
+
+    def __init__(self, num_buffers : int, max_batch_size : int, frame_shape, dtype=np.float32):
+        """
+        Pool of preallocated batch tensors, recycled between the multiplexer and its sink.
+        Frames are written into a free buffer in place and short batches are views of it,
+        so no batch array is allocated after start up.
+        Parameters
+        ----------
+        num_buffers    : int
+                         number of batch tensors, multiplexer blocks when all of them are in use
+        max_batch_size : int
+                         first dimension of every batch tensor
+        frame_shape    : tuple
+                         shape of a single frame, e.g (3, 640, 640)
+        dtype          : numpy dtype
+                         data type of the batch tensors
+        """
+        self.free_buffers = LifoQueue()  # hand out the most recently used buffer first, it is still warm in cache
+        for _ in range(num_buffers):
+            self.free_buffers.put(np.empty((max_batch_size,) + tuple(frame_shape), dtype=dtype))
+
+    def acquire(self):
+        """
+        Wait until the sink gave a batch tensor back and return it.
+        """
+        return self.free_buffers.get()
+
+    def release(self, buffer):
+        """
+        Give a batch tensor, or any view of it, back to the pool once the sink is done with it.
+        """
+        while buffer.base is not None:
+            buffer = buffer.base
+        self.free_buffers.put(buffer)
 
 class VideoReader(threading.Thread):
-    def __init__(self, video, queue):
+    def __init__(self, video, queue, storage : str ="float32", backend : str ="opencv", metrics=None, stream : int =0):
         super().__init__()
         self.video_path = os.path.abspath(video)
         self.vid_name = os.path.splitext(self.video_path)[0].split("/")[-1]
-        self.vidcap = cv2.VideoCapture(self.video_path)
+        # "ffmpeg" decodes through an ffmpeg rawvideo pipe into preallocated frame buffers
+        self.vidcap = FFmpegVideoCapture(self.video_path) if backend == "ffmpeg" else cv2.VideoCapture(self.video_path)
 
         self.queue = queue
+        # frames put on the queue are counted as produced by `stream`, nothing is printed per frame
+        self.metrics = metrics
+        self.stream = stream
 
         self.preprocess_fn = Preprocess(input_size=640)
+        if storage == "uint8":
+            # letterboxed canvases only, 4x less data, FrameStore.load normalizes them
+            self.preprocess_fn = self.preprocess_fn.letterbox
 
     def run(self):
         
@@ -146,79 +352,116 @@ class VideoReader(threading.Thread):
                 break
             else:
                 np_frame = self.preprocess_fn(frame)
+                # counted before the put, the consumer can take the frame as soon as it is on the queue
+                if self.metrics is not None:
+                    self.metrics.produced(self.stream)
                 self.queue.put(np_frame)
-                print("Writer {} Queue Length : {}".format(self.vid_name, self.queue.qsize()))
 
+        self.vidcap.release()
 
-def batch_multiplex(first_queue, second_queue):
-    
-    # Read from multiple queues, this will be spawned as a seperate process
 
-    # make a batch numpy array and save it as a npy file
+def batch_multiplex(queues, max_batch_size : int =8, max_wait : float =0.05, poll_interval : float =0.001,
+                    num_buffers : int =4, num_writers : int =1, frame_shape=(3, 640, 640), storage : str ="float32",
+                    metrics=None):
+    """
+    Read frames from any number of stream queues and save them in dynamic batches.
+    A batch is flushed as soon as it holds `max_batch_size` frames or `max_wait` seconds
+    passed since its first frame arrived, so a slow stream never stalls the others.
+    Streams that sent "DONE" leave the batch, the multiplexer returns once all of them did.
+    Parameters
+    ----------
+    queues         : list
+                     one queue per stream, carrying the preprocessed frames
+    max_batch_size : int
+                     maximum number of frames in a batch
+    max_wait       : float
+                     latency deadline in seconds, measured from the first frame of the batch
+    poll_interval  : float
+                     sleep time in seconds when none of the streams has a frame ready
+    num_buffers    : int
+                     number of preallocated batch tensors shared with the sink
+    num_writers    : int
+                     number of background threads writing the batches to disk
+    frame_shape    : tuple
+                     shape of a single preprocessed frame
+    storage        : str
+                     data type of the frames, "float32" or "uint8" letterboxed canvases
+    metrics        : QueueMetrics
+                     optional, counts the frames consumed from every stream and the batches, see queue_metrics
+    """
     count = 0
-    first = True
-    second = True
-
-    while True:
-        # get data from noth queue simultaneously
-        if first and second:
-            first_frame = first_queue.get()
-            second_frame = second_queue.get()
-        elif first and not second:
-            first_frame = first_queue.get()
-            second_frame = "DONE"
-        elif not first and second:
-            first_frame = "DONE"
-            second_frame = second_queue.get()
-        else:
-            first_frame = "DONE"
-            second_frame = "DONE"
-
-        # Configure npy file path
-        npy_path = "%s/%s/out-%04d.npy" % ("data", "queue", count)
-
-        if isinstance(first_frame, np.ndarray) and isinstance(second_frame, np.ndarray):
-            batch_array = np.vstack((first_frame, second_frame))
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
-            count += 1
-            print("Batch")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
-        elif isinstance(first_frame, np.ndarray) and second_frame == "DONE":
-            batch_array = first_frame
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
-            count += 1
-            second = False
-            print("Single")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
-        elif isinstance(second_frame, np.ndarray) and first_frame == "DONE":
-            batch_array = second_frame
-            print("dimensions : {}".format(batch_array.shape))
-            np.save(npy_path, batch_array)
-            count += 1
-            first = False
-            print("Single")
-            print("Reader first queue length : {}".format(first_queue.qsize()))
-            print("Reader second queue length : {}".format(second_queue.qsize()))
-        else:
-            break
+    active = list(range(len(queues)))
+    frame_counts = [0] * len(queues)  # number of frames received so far from every stream
+    pool = BatchBufferPool(num_buffers, max_batch_size, frame_shape, dtype=storage)
+    # every batch goes into one append-only store instead of one npy file per batch
+    store = AsyncFrameStoreWriter("%s/%s/frames" % ("data", "queue"), frame_shape=frame_shape, dtype=storage,
+                                  fields=("batch", "stream", "frame"), num_workers=num_writers, max_pending=num_buffers)
+
+    while active:
+        batch = []  # (stream, frame index) pairs of the frames in the batch
+        deadline = None
+        buffer = pool.acquire()
+
+        while active and len(batch) < max_batch_size:
+            received = False
+            # poll every live stream once per pass, so each stream gets a fair share of the batch
+            for stream in list(active):
+                try:
+                    frame = queues[stream].get_nowait()
+                except Empty:
+                    continue
+                received = True
+                if not isinstance(frame, np.ndarray):
+                    active.remove(stream)
+                    continue
+                buffer[len(batch):len(batch) + 1] = frame  # write the frame into its row of the batch tensor
+                if metrics is not None:
+                    metrics.consumed(stream)
+                batch.append((stream, frame_counts[stream]))
+                frame_counts[stream] += 1
+                if deadline is None:
+                    deadline = time.time() + max_wait
+                if len(batch) == max_batch_size:
+                    break
+
+            if deadline is not None and time.time() >= deadline:
+                break
+            if not received:
+                time.sleep(poll_interval)
+
+        if not batch:
+            pool.release(buffer)
+            continue
+
+        batch_array = buffer[:len(batch)]  # short batches are a view of the full tensor
+        # batch, source stream and frame number of every row, the writer hands the buffer back to the pool
+        store.append(batch_array, keys=[(count, stream, index) for stream, index in batch], on_done=pool.release)
+        count += 1
+        if metrics is not None:
+            metrics.batched()
+
+    store.close()
+    print("Writer saved {saved_time:.3f}s of the batching loop ({write_time:.3f}s writing, {wait_time:.3f}s waiting)".format(**store.report()))
 
 if __name__ == "__main__":
 
-    first_queue = Queue()
-    second_queue = Queue()
+    videos = ["videos/1.mp4", "videos/2.mp4"]
+    storage = "float32"  # "uint8" moves and saves letterboxed canvases, 4x less data
+    backend = "opencv"   # "ffmpeg" decodes through an ffmpeg rawvideo pipe
 
-    vid_reader1 = VideoReader(video="videos/1.mp4", queue=first_queue)
-    vid_reader2 = VideoReader(video="videos/2.mp4", queue=second_queue)
+    # queue depths, rates and drops of every stream, sampled and printed once a second by a side thread
+    metrics = QueueMetrics([os.path.splitext(os.path.basename(video))[0] for video in videos], interval=1.0)
 
-    vid_reader1.start()
-    vid_reader2.start()
+    queues = [Queue() for _ in videos]
+    vid_readers = [VideoReader(video=video, queue=queue, storage=storage, backend=backend, metrics=metrics, stream=i)
+                   for i, (video, queue) in enumerate(zip(videos, queues))]
 
+    for vid_reader in vid_readers:
+        vid_reader.start()
 
-    batch_multiplex(first_queue=first_queue, second_queue=second_queue)
+    metrics.start()
+    batch_multiplex(queues=queues, max_batch_size=8, max_wait=0.05, storage=storage, metrics=metrics)
+    metrics.stop()
 
-    vid_reader1.join()
-    vid_reader2.join()
\ No newline at end of file
+    for vid_reader in vid_readers:
+        vid_reader.join()
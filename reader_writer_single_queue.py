@@ -1,10 +1,28 @@
 """
 https://stackoverflow.com/questions/11515944/how-to-use-multiprocessing-queue-in-python
+
+1. Sending numbers through a multiprocessing Queue
+2. Sending frame sized payloads (uint8 arrays of 1 - 25 MB) from producers to consumers through
+   mp.Queue       : multiprocessing.Queue(maxsize=depth), pickled in a feeder thread
+   mp.SimpleQueue : pickled by put itself, no feeder thread
+   mp.Pipe        : one pipe per producer / consumer pair
+   queue.Queue    : threads of a single process, only references are passed, nothing is copied
+   shared_memory  : producers copy payloads into slots of a SharedMemory block, only slot numbers go through queues
+   pickle5        : one pipe per pair, pickle protocol 5 with the array data sent out-of-band and
+                    received into a preallocated buffer, no pickled copy of the data on either side
+   for every payload size and number of producers / consumers, reporting messages/s, MB/s and the
+   p50 / p99 latency from send to receive (payloads carry their send time, perf_counter is system wide)
 """
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, SimpleQueue, Pipe, Event
+from multiprocessing import shared_memory
+import queue as thread_queue
+import threading
+import pickle
 import time
 import sys
 
+import numpy as np
+
 def reader_proc(queue):
     ## Read from the queue; this will be spawned as a separate Process
     while True:
@@ -18,9 +36,210 @@ def writer(count, queue):
         queue.put(ii)             # Write 'count' numbers into the queue
     queue.put('DONE')
 
+class QueueChannel(object):
+    # multiprocessing.Queue, SimpleQueue or queue.Queue, any number of producers and consumers
+    def __init__(self, queue):
+        self.queue = queue
+
+    def send(self, payload):
+        self.queue.put(payload)
+
+    def recv(self):
+        return self.queue.get()
+
+    def done(self):
+        pass
+
+    def close(self):
+        self.queue.put(None)
+
+class PipeChannel(object):
+    # One end of a multiprocessing Pipe, a single producer and a single consumer
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, payload):
+        self.conn.send(payload)
+
+    def recv(self):
+        return self.conn.recv()
+
+    def done(self):
+        pass
+
+    def close(self):
+        self.conn.send(None)
+
+class Pickle5Channel(object):
+    # Pipe carrying a protocol 5 pickle without the array data, followed by the raw data
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.size = size
+        self._buffer = None
+
+    def send(self, payload):
+        buffers = []
+        header = pickle.dumps(payload, protocol=5, buffer_callback=buffers.append)
+        self.conn.send_bytes(header)
+        for buffer in buffers:
+            self.conn.send_bytes(buffer.raw())
+
+    def recv(self):
+        header = self.conn.recv_bytes()
+        if not header:
+            return None
+        if self._buffer is None:
+            self._buffer = bytearray(self.size)  # every payload is received into this one buffer
+        count = self.conn.recv_bytes_into(self._buffer)
+        return pickle.loads(header, buffers=[memoryview(self._buffer)[:count]])
+
+    def done(self):
+        pass
+
+    def close(self):
+        self.conn.send_bytes(b"")
+
+class SharedMemoryChannel(object):
+    # Slots of a SharedMemory block, free and full slot numbers go through two queues
+    def __init__(self, num_slots, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * size)
+        self.num_slots = num_slots
+        self.size = size
+        self.free_slots = Queue()
+        self.full_slots = Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        self._slots = None
+        self._slot = None
+
+    @property
+    def slots(self):
+        if self._slots is None:
+            self._slots = np.ndarray((self.num_slots, self.size), dtype=np.uint8, buffer=self.shm.buf)
+        return self._slots
+
+    def __getstate__(self):
+        # slots are a view of the attaching process' own mapping
+        state = self.__dict__.copy()
+        state["_slots"] = None
+        return state
+
+    def send(self, payload):
+        slot = self.free_slots.get()
+        self.slots[slot] = payload
+        self.full_slots.put(slot)
+
+    def recv(self):
+        self._slot = self.full_slots.get()
+        if self._slot is None:
+            return None
+        return self.slots[self._slot]  # no copy, valid until done()
+
+    def done(self):
+        self.free_slots.put(self._slot)
+
+    def close(self):
+        self.full_slots.put(None)
+
+    def unlink(self):
+        self._slots = None
+        self.shm.close()
+        self.shm.unlink()
+
+def make_channels(transport, producers, consumers, size, depth):
+    """
+    Channels of the producers and of the consumers of a transport.
+
+    Returns
+    -------
+    senders     : list
+                  channel of every producer
+    receivers   : list
+                  channel of every consumer
+    pairs       : bool
+                  True if producer i only talks to consumer i
+    """
+    if transport in ("mp.Pipe", "pickle5"):
+        assert producers == consumers, "Pipes connect a single producer to a single consumer."
+        ends = [Pipe(duplex=False) for _ in range(producers)]
+        if transport == "mp.Pipe":
+            return [PipeChannel(send) for _, send in ends], [PipeChannel(recv) for recv, _ in ends], True
+        return [Pickle5Channel(send, size) for _, send in ends], [Pickle5Channel(recv, size) for recv, _ in ends], True
+
+    if transport == "shared_memory":
+        channel = SharedMemoryChannel(num_slots=depth * producers, size=size)
+    elif transport == "mp.Queue":
+        channel = QueueChannel(Queue(maxsize=depth))
+    elif transport == "mp.SimpleQueue":
+        channel = QueueChannel(SimpleQueue())
+    elif transport == "queue.Queue":
+        channel = QueueChannel(thread_queue.Queue(maxsize=depth))
+    else:
+        raise ValueError("Unknown transport {}".format(transport))
+    return [channel] * producers, [channel] * consumers, False
+
+def producer(channel, size, count, depth, go):
+    # Send `count` payloads, a few arrays in turn, one is only written again after depth + 1 others were sent
+    payloads = [np.ones(size, dtype=np.uint8) for _ in range(depth + 2)]
+    go.wait()
+    for i in range(count):
+        payload = payloads[i % len(payloads)]
+        payload[:8].view(np.float64)[0] = time.perf_counter()  # send time
+        channel.send(payload)
+
+def consumer(channel, results):
+    # Receive payloads until the end of the stream, keep the latency of every one
+    latencies = []
+    while True:
+        payload = channel.recv()
+        if payload is None:
+            break
+        latencies.append(time.perf_counter() - payload[:8].view(np.float64)[0])
+        channel.done()
+    results.put(latencies)
+
+def run(transport, size, producers, consumers, count, depth : int =4):
+    """
+    Send `count` payloads of `size` bytes from every producer.
+
+    Returns
+    -------
+    elapsed     : float
+                  seconds from the start of the producers until the last payload was received
+    latencies   : numpy array
+                  send to receive time of every payload in seconds
+    """
+    senders, receivers, pairs = make_channels(transport, producers, consumers, size, depth)
+    # threads for queue.Queue, processes for everything else
+    threaded = transport == "queue.Queue"
+    Worker, Results, Go = (threading.Thread, thread_queue.Queue, threading.Event) if threaded else (Process, Queue, Event)
+    go = Go()
+    results = Results()
+
+    producer_ps = [Worker(target=producer, args=(sender, size, count, depth, go), daemon=True) for sender in senders]
+    consumer_ps = [Worker(target=consumer, args=(receiver, results), daemon=True) for receiver in receivers]
+    for worker in consumer_ps + producer_ps:
+        worker.start()
+
+    _start = time.perf_counter()
+    go.set()
+    for worker in producer_ps:
+        worker.join()
+    # one end of stream for every consumer
+    for sender in (senders if pairs else [senders[0]] * consumers):
+        sender.close()
+    latencies = [results.get() for _ in consumer_ps]
+    elapsed = time.perf_counter() - _start
+    for worker in consumer_ps:
+        worker.join()
+
+    if transport == "shared_memory":
+        senders[0].unlink()
+    return elapsed, np.concatenate([np.asarray(l) for l in latencies])
+
 if __name__=='__main__':
     pqueue = Queue() # writer() writes to pqueue from _this_ process
-    for count in [10**4, 10**5, 10**6]:             
+    for count in [10**4, 10**5, 10**6]:
         ### reader_proc() reads from pqueue as a separate process
         reader_p = Process(target=reader_proc, args=((pqueue),))
         reader_p.daemon = True
@@ -29,5 +248,23 @@ if __name__=='__main__':
         _start = time.time()
         writer(count, pqueue)    # Send a lot of stuff to reader()
         reader_p.join()         # Wait for the reader to finish
-        print("Sending {0} numbers to Queue() took {1} seconds".format(count, 
-            (time.time() - _start)))
\ No newline at end of file
+        print("Sending {0} numbers to Queue() took {1} seconds".format(count,
+            (time.time() - _start)))
+
+    # frame sized payloads, 1 MB, a 640x640 float32 tensor, a 1920x1080 float32 tensor
+    sizes = [int(s) for s in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1024**2, 3 * 640 * 640 * 4, 3 * 1920 * 1080 * 4]
+    workers = [(1, 1), (2, 2), (4, 1), (1, 4)]
+    transports = ["mp.Queue", "mp.SimpleQueue", "mp.Pipe", "queue.Queue", "shared_memory", "pickle5"]
+    total_bytes = 1024**3  # sent per run, split among the producers
+
+    for size in sizes:
+        for producers, consumers in workers:
+            count = max(10, total_bytes // size // producers)
+            for transport in transports:
+                if transport in ("mp.Pipe", "pickle5") and producers != consumers:
+                    continue
+                elapsed, latencies = run(transport, size, producers, consumers, count)
+                messages = producers * count
+                print("{:7.2f} MB x {:4d}, {} -> {} {:14s} : {:8.1f} msg/s {:8.1f} MB/s, latency p50 {:7.2f} ms p99 {:7.2f} ms".format(
+                    size / 1024**2, messages, producers, consumers, transport, messages / elapsed,
+                    messages * size / 1024**2 / elapsed, 1000 * np.percentile(latencies, 50), 1000 * np.percentile(latencies, 99)))
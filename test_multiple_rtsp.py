@@ -0,0 +1,61 @@
+import queue
+
+from h264_stream import AccessUnitParser
+from multiple_rtsp import SegmentRecorder
+
+# hand made NAL units, 4 byte start code, header, a few payload bytes
+AUD = b"\x00\x00\x00\x01\x09\xf0"
+SPS = b"\x00\x00\x00\x01\x67\x42\x00\x1e\xab"
+PPS = b"\x00\x00\x00\x01\x68\xce\x38\x80"
+IDR = b"\x00\x00\x00\x01\x65\x88\x84\x21"
+I_SLICE = b"\x00\x00\x00\x01\x41\x88\x84\x21"   # non-IDR, first_mb_in_slice 0, slice_type 7 (I)
+P_SLICE = b"\x00\x00\x00\x01\x41\x9a\x02\x11"   # non-IDR, first_mb_in_slice 0, slice_type 5 (P)
+RECOVERY_POINT = b"\x00\x00\x00\x01\x06\x06\x01\xc4\x80"
+
+
+def record(units, folder, **kwargs):
+    # Run a recorder over (access unit, keyframe) pairs, a new segment is due at every keyframe
+    q = queue.Queue()
+    for unit in units:
+        q.put(unit)
+    q.put(None)
+    recorder = SegmentRecorder(q, str(folder), max_bytes=1, max_segments=None, **kwargs)
+    recorder.run()
+    return recorder, [open(path, "rb").read() for path in recorder.segments]
+
+
+def test_parameter_sets_follow_the_delimiter(tmp_path):
+    recorder, segments = record([(AUD + SPS + PPS + IDR, True), (AUD + P_SLICE, False), (AUD + IDR, True)], tmp_path)
+    assert len(segments) == 2
+    assert segments[0] == AUD + SPS + PPS + IDR + AUD + P_SLICE
+    # the AUD stays the first NAL unit of the access unit
+    assert segments[1] == AUD + SPS + PPS + IDR
+
+
+def test_saved_pps_never_precedes_carried_sps(tmp_path):
+    recorder, segments = record([(AUD + SPS + PPS + IDR, True), (AUD + P_SLICE, False), (AUD + SPS + IDR, True)],
+                                tmp_path)
+    segment = segments[1]
+    assert segment.startswith(AUD + SPS + PPS)
+    assert segment.endswith(SPS + IDR)
+
+
+def test_recovery_point_i_frames_are_keyframes(tmp_path):
+    stream = (SPS + PPS + RECOVERY_POINT + I_SLICE + P_SLICE + P_SLICE) * 3
+    parser = AccessUnitParser()
+    units = parser.feed(stream[:50]) + parser.feed(stream[50:]) + parser.flush()
+    assert [keyframe for _, keyframe in units] == [True, False, False] * 3
+
+    recorder, segments = record(units, tmp_path)
+    assert recorder.skipped == 0
+    assert len(segments) == 3 and segments[0].startswith(SPS + PPS + RECOVERY_POINT)
+
+
+def test_i_slice_without_recovery_point_is_no_keyframe(tmp_path, capsys):
+    parser = AccessUnitParser()
+    units = parser.feed((SPS + PPS + I_SLICE + P_SLICE) * 2) + parser.flush()
+    assert not any(keyframe for _, keyframe in units)
+
+    recorder, segments = record(units, tmp_path, max_skipped=3)
+    assert recorder.skipped == 4 and segments == []
+    assert "no keyframe in 3 access units" in capsys.readouterr().out